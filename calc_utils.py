@@ -1,4 +1,6 @@
 import math
+import heapq
+import numpy as np
 from logging import debug, info, warning, error, critical
 from util import dbgfname
 
@@ -95,6 +97,141 @@ def find_center_of_mass(path):
     y_center = float(y)/len(path)
     return x_center, y_center
 
+def circle_segment_intersections(center, radius, s, e, bounded=True):
+    dx = e[0]-s[0]
+    dy = e[1]-s[1]
+    fx = s[0]-center[0]
+    fy = s[1]-center[1]
+    a = dx**2+dy**2
+    if a < 1e-12:
+        return []
+    b = 2*(fx*dx+fy*dy)
+    c = fx**2+fy**2-radius**2
+    desc = b**2-4*a*c
+    if desc < 0:
+        return []
+    sq = math.sqrt(desc)
+    intersections = []
+    for t in set([(-b-sq)/(2*a), (-b+sq)/(2*a)]):
+        if (t>=0 and t<=1) or not bounded:
+            intersections.append((s[0]+t*dx, s[1]+t*dy))
+    return intersections
+
+def line_line_intersection(s1, e1, s2, e2):
+    d1x = e1[0]-s1[0]
+    d1y = e1[1]-s1[1]
+    d2x = e2[0]-s2[0]
+    d2y = e2[1]-s2[1]
+    det = d1x*d2y-d1y*d2x
+    if abs(det) < 1e-12:
+        return None
+    t = ((s2[0]-s1[0])*d2y-(s2[1]-s1[1])*d2x)/det
+    return (s1[0]+t*d1x, s1[1]+t*d1y)
+
+def circle_circle_intersections(c1, r1, c2, r2):
+    d = pt_to_pt_dist(c1, c2)
+    if d < 1e-12 or d > r1+r2 or d < abs(r1-r2):
+        return []
+    a = (r1**2-r2**2+d**2)/(2*d)
+    h = math.sqrt(max(r1**2-a**2, 0))
+    mx = c1[0]+a*(c2[0]-c1[0])/d
+    my = c1[1]+a*(c2[1]-c1[1])/d
+    if h == 0:
+        return [(mx, my)]
+    return [(mx+h*(c2[1]-c1[1])/d, my-h*(c2[0]-c1[0])/d),
+            (mx-h*(c2[1]-c1[1])/d, my+h*(c2[0]-c1[0])/d)]
+
+# start and end points of a linearized path as two (E, 2) arrays
+def linearized_path_to_arrays(path):
+    starts = np.array([[e.start[0], e.start[1]] for e in path], dtype=float).reshape(-1, 2)
+    ends = np.array([[e.end[0], e.end[1]] for e in path], dtype=float).reshape(-1, 2)
+    return starts, ends
+
+# Batch version of TOPocketing.__is_pt_inside_path_winding: classifies (N, 2)
+# points against the segments starts[i]->ends[i] with the same crossing and
+# halfcrossing rules, returns a boolean mask of length N. Points are
+# processed in chunks to keep the (chunk, E) temporaries bounded.
+def pts_in_path_winding(pts, starts, ends, chunk_size=None):
+    pts = np.asarray(pts, dtype=float).reshape(-1, 2)
+    starts = np.asarray(starts, dtype=float).reshape(-1, 2)
+    ends = np.asarray(ends, dtype=float).reshape(-1, 2)
+    inside = np.zeros(len(pts), dtype=bool)
+    if len(starts) == 0 or len(pts) == 0:
+        return inside
+    if chunk_size == None:
+        chunk_size = max(1, 1000000//len(starts))
+
+    v2x = ends[:, 0]-starts[:, 0]
+    v2y = ends[:, 1]-starts[:, 1]
+    for c in range(0, len(pts), chunk_size):
+        p = pts[c:c+chunk_size]
+        sx = starts[:, 0][None, :]-p[:, 0][:, None]
+        sy = starts[:, 1][None, :]-p[:, 1][:, None]
+        ey = ends[:, 1][None, :]-p[:, 1][:, None]
+
+        s_on = np.abs(sy)<0.0001
+        e_on = np.abs(ey)<0.0001
+        halfcross_s = s_on & (np.abs(ey)>0.0001)
+        halfcross_e = e_on & (np.abs(sy)>0.0001)
+        halfcross = halfcross_s | halfcross_e
+        crossing = (~halfcross) & ((sy<0) != (ey<0))
+
+        up = np.where(halfcross_s, ey>0, np.where(halfcross_e, sy<=0, ey>sy))
+        cross_product = sx*v2y[None, :]-sy*v2x[None, :]
+        at_left = np.where(up, cross_product>0, cross_product<0)
+
+        weight = np.where(halfcross, 0.5, np.where(crossing, 1.0, 0.0))
+        weight = np.where(up, weight, -weight)
+        turns = (weight*at_left).sum(axis=1)
+        inside[c:c+chunk_size] = np.abs(turns)>=1
+    return inside
+
+# Distances from pt to every segment starts[i]->ends[i], same rules as
+# LineUtils.distance_to_pt
+def pt_to_segments_dist(pt, starts, ends):
+    return pts_to_segments_dist_matrix([pt], starts, ends)[0]
+
+# (N, E) matrix of distances from every point to every segment
+def pts_to_segments_dist_matrix(pts, starts, ends):
+    pts = np.asarray(pts, dtype=float).reshape(-1, 2)
+    starts = np.asarray(starts, dtype=float).reshape(-1, 2)
+    ends = np.asarray(ends, dtype=float).reshape(-1, 2)
+    se = ends-starts
+    l2 = (se**2).sum(axis=1)
+    degenerate = l2<0.0001
+    safe_l2 = np.where(degenerate, 1.0, l2)
+
+    px = pts[:, 0][:, None]-starts[:, 0][None, :]
+    py = pts[:, 1][:, None]-starts[:, 1][None, :]
+    cosine = (px*se[:, 0][None, :]+py*se[:, 1][None, :])/safe_l2[None, :]
+    cosine = np.where(degenerate[None, :], 0.0, np.clip(cosine, 0.0, 1.0))
+    dx = px-cosine*se[:, 0][None, :]
+    dy = py-cosine*se[:, 1][None, :]
+    return np.sqrt(dx**2+dy**2)
+
+def normalize_angles_arr(a):
+    return np.where(a<0, a+2*math.pi, a)
+
+def angledist_arr(s, e):
+    s = normalize_angles_arr(s)
+    e = normalize_angles_arr(e)
+    return np.where(e<s, (2*math.pi-s)+e, e-s)
+
+# Distances from pt to arcs given by centers (A, 2), radii, start and end
+# angles in radians, same rules as ArcUtils.distance_to_pt (1000 when pt is
+# outside of the arc angle range)
+def pt_to_arcs_dist(pt, centers, radii, startangles, endangles):
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    radii = np.asarray(radii, dtype=float)
+    sa = np.asarray(startangles, dtype=float)
+    ea = np.asarray(endangles, dtype=float)
+    dx = pt[0]-centers[:, 0]
+    dy = pt[1]-centers[:, 1]
+    a = np.arctan2(dy, dx)
+    in_range = (angledist_arr(sa, a)+angledist_arr(a, ea)) == angledist_arr(sa, ea)
+    dist = np.where(in_range, np.sqrt(dx**2+dy**2)-radii, 1000)
+    return np.abs(dist)
+
 class OverlapEnum:
     fully_covers = 1
     partially_overlap = 2
@@ -470,6 +607,905 @@ class LineUtils:
     def __reproject_pt(self, pt, sina, cosa):
         return (pt[0]*cosa-pt[1]*sina, pt[0]*sina+pt[1]*cosa)
 
+# Uniform grid over the calc utils of a path, answers "is any element within
+# r of pt" by looking only at the buckets around pt. Lines are rasterized
+# column by column, so long segments occupy O(length/cell) buckets, other
+# utils are put into every bucket their AABB touches.
+class ElementGrid:
+    def __init__(self, elements, cell_size=None):
+        self.cus = [e.get_cu() for e in elements]
+        if cell_size == None:
+            cell_size = self.__mean_extent()
+        self.cell_size = max(cell_size, 0.001)
+        self.buckets = {}
+        for i, cu in enumerate(self.cus):
+            if cu.__class__.__name__ == "LineUtils":
+                self.__add_line(i, cu)
+            else:
+                if cu.__class__.__name__ == "ArcUtils":
+                    # ArcUtils AABB covers the endpoints only
+                    aabb = CircleUtils(cu.center, cu.radius).get_aabb()
+                else:
+                    aabb = cu.get_aabb()
+                self.__add_range(i, aabb.left, aabb.bottom, aabb.right, aabb.top)
+
+    def __mean_extent(self):
+        if len(self.cus) == 0:
+            return 1.0
+        total = 0
+        for cu in self.cus:
+            aabb = cu.get_aabb()
+            total += max(aabb.right-aabb.left, aabb.top-aabb.bottom)
+        return total/float(len(self.cus))
+
+    def __cell(self, v):
+        return int(math.floor(v/self.cell_size))
+
+    def __add_range(self, i, left, bottom, right, top):
+        for cx in range(self.__cell(left), self.__cell(right)+1):
+            for cy in range(self.__cell(bottom), self.__cell(top)+1):
+                self.buckets.setdefault((cx, cy), []).append(i)
+
+    def __add_line(self, i, lu):
+        sx, sy = lu.start[0], lu.start[1]
+        ex, ey = lu.end[0], lu.end[1]
+        if sx > ex:
+            sx, sy, ex, ey = ex, ey, sx, sy
+        dx = ex-sx
+        for cx in range(self.__cell(sx), self.__cell(ex)+1):
+            x0 = max(sx, cx*self.cell_size)
+            x1 = min(ex, (cx+1)*self.cell_size)
+            if dx == 0:
+                y0, y1 = sy, ey
+            else:
+                y0 = sy+(x0-sx)*(ey-sy)/dx
+                y1 = sy+(x1-sx)*(ey-sy)/dx
+            for cy in range(self.__cell(min(y0, y1)), self.__cell(max(y0, y1))+1):
+                self.buckets.setdefault((cx, cy), []).append(i)
+
+    def get_candidates(self, pt, r):
+        candidates = set()
+        for cx in range(self.__cell(pt[0]-r), self.__cell(pt[0]+r)+1):
+            for cy in range(self.__cell(pt[1]-r), self.__cell(pt[1]+r)+1):
+                if (cx, cy) in self.buckets:
+                    candidates.update(self.buckets[(cx, cy)])
+        return candidates
+
+    def is_pt_close(self, pt, r):
+        for i in self.get_candidates(pt, r):
+            if self.cus[i].distance_to_pt(pt)<=r:
+                return True
+        return False
+
+def segment_segment_intersection(s1, e1, s2, e2, eps=1e-9):
+    d1x = e1[0]-s1[0]
+    d1y = e1[1]-s1[1]
+    d2x = e2[0]-s2[0]
+    d2y = e2[1]-s2[1]
+    det = d1x*d2y-d1y*d2x
+    if det == 0:
+        return None
+    t = ((s2[0]-s1[0])*d2y-(s2[1]-s1[1])*d2x)/det
+    u = ((s2[0]-s1[0])*d1y-(s2[1]-s1[1])*d1x)/det
+    if t<-eps or t>1+eps or u<-eps or u>1+eps:
+        return None
+    return (s1[0]+t*d1x, s1[1]+t*d1y)
+
+# x-monotone part of an element used by the sweep line: a line, or a part
+# of an arc laying in the upper or lower half of its circle
+class SweepPiece:
+    def __init__(self, idx, left, right, center=None, radius=None, upper=None):
+        self.idx = idx
+        self.left = left
+        self.right = right
+        self.center = center
+        self.radius = radius
+        self.upper = upper
+
+    def is_arc(self):
+        return self.center != None
+
+    def y_at(self, x):
+        if x <= self.left[0]:
+            return self.left[1]
+        if x >= self.right[0]:
+            return self.right[1]
+        if self.is_arc():
+            # (r-dx)*(r+dx) keeps precision near the vertical tangents
+            dx = abs(x-self.center[0])
+            dy = math.sqrt(max((self.radius-dx)*(self.radius+dx), 0))
+            if self.upper:
+                return self.center[1]+dy
+            return self.center[1]-dy
+        dx = self.right[0]-self.left[0]
+        if dx == 0:
+            return self.left[1]
+        return self.left[1]+(x-self.left[0])*(self.right[1]-self.left[1])/dx
+
+    # slope right after x, orders pieces leaving the same point
+    def slope_at(self, x):
+        if self.is_arc():
+            # the sign of dy comes from the side of the piece, the rounded
+            # endpoints can be on either side of the center at x extremes
+            x = min(max(x, self.left[0]), self.right[0])
+            dx = x-self.center[0]
+            dy = math.sqrt(max((self.radius-abs(dx))*(self.radius+abs(dx)), 0))
+            if not self.upper:
+                dy = -dy
+            if abs(dy) <= 1e-12*self.radius:
+                if (self.upper and dx<0) or ((not self.upper) and dx>0):
+                    return float("inf")
+                return float("-inf")
+            return -dx/dy
+        dx = self.right[0]-self.left[0]
+        if dx == 0:
+            return float("inf")
+        return (self.right[1]-self.left[1])/dx
+
+    def has_pt(self, pt, eps):
+        if pt[0]<self.left[0]-eps or pt[0]>self.right[0]+eps:
+            return False
+        if self.is_arc():
+            if self.upper:
+                return pt[1]>=self.center[1]-eps
+            return pt[1]<=self.center[1]+eps
+        return True
+
+    def intersections(self, other, eps):
+        if self.is_arc() and other.is_arc():
+            pts = circle_circle_intersections(self.center, self.radius, other.center, other.radius)
+        elif self.is_arc():
+            pts = circle_segment_intersections(self.center, self.radius, other.left, other.right)
+        elif other.is_arc():
+            pts = circle_segment_intersections(other.center, other.radius, self.left, self.right)
+        else:
+            pt = segment_segment_intersection(self.left, self.right, other.left, other.right)
+            pts = [] if pt == None else [pt]
+        return [pt for pt in pts if self.has_pt(pt, eps) and other.has_pt(pt, eps)]
+
+# Bentley-Ottmann sweep line over ELine, EArc and ECircle elements. Arcs are
+# split into x-monotone pieces, status holds pieces ordered by y at the
+# sweep position and only neighbours in status are intersected, so all
+# intersecting pairs are found with O(n+k) intersection tests and event
+# queue operations of O(log n) for n elements and k intersections. Status
+# is a plain list: locating pieces ending at an event and replacing the
+# pieces through it are linear in the status size s, so the whole sweep is
+# O((n+k) s) in the worst case, done by list scans and moves in C. Degenerate cases (several pieces through one point,
+# shared endpoints, overlaps) are handled by collecting all pieces passing
+# through an event point. The input is rotated by a small angle during the
+# sweep so that there are no vertical lines. Returns a list of
+# (i, j, pt) with i<j indices into elements, intersections laying at
+# endpoints of both elements are skipped when ignore_endpoints is set.
+class SweepLine:
+    angle = 0.0017
+
+    def __init__(self, elements, eps=1e-7):
+        self.elements = elements
+        self.eps = eps
+        self.cosa = math.cos(self.angle)
+        self.sina = math.sin(self.angle)
+        self.pieces = []
+        for i, e in enumerate(elements):
+            self.__add_element(i, e)
+
+    def __rotate(self, pt, sina=None):
+        if sina == None:
+            sina = self.sina
+        return (pt[0]*self.cosa-pt[1]*sina, pt[0]*sina+pt[1]*self.cosa)
+
+    def __add_piece(self, idx, a, b, center=None, radius=None, upper=None):
+        if a > b:
+            a, b = b, a
+        self.pieces.append(SweepPiece(idx, a, b, center, radius, upper))
+
+    def __add_element(self, idx, e):
+        name = type(e).__name__
+        if name == "ELine":
+            self.__add_piece(idx, self.__rotate(e.start), self.__rotate(e.end))
+            return
+        if name == "EArc":
+            if e.is_turnaround:
+                a0, a1 = e.endangle, e.startangle
+            else:
+                a0, a1 = e.startangle, e.endangle
+            sweep = a1-a0
+        elif name == "ECircle":
+            a0 = 0
+            sweep = 2*math.pi
+        else:
+            debug("  SweepLine: unsupported element "+name)
+            return
+        while sweep <= 0:
+            sweep += 2*math.pi
+        while sweep > 2*math.pi:
+            sweep -= 2*math.pi
+        c = self.__rotate(e.center)
+        r = e.radius
+        a0 += self.angle
+        a1 = a0+sweep
+        # split at x extremes of the circle
+        cuts = [a0]
+        k = math.floor(a0/math.pi)+1
+        while k*math.pi < a1:
+            cuts.append(k*math.pi)
+            k += 1
+        cuts.append(a1)
+        for i in range(len(cuts)-1):
+            b0 = cuts[i]
+            b1 = cuts[i+1]
+            if b1-b0 < 1e-12:
+                continue
+            upper = math.sin((b0+b1)/2.0) > 0
+            p0 = (c[0]+r*math.cos(b0), c[1]+r*math.sin(b0))
+            p1 = (c[0]+r*math.cos(b1), c[1]+r*math.sin(b1))
+            self.__add_piece(idx, p0, p1, c, r, upper)
+
+    def __key(self, pt):
+        return (int(round(pt[0]/self.eps)), int(round(pt[1]/self.eps)))
+
+    def __push_event(self, pt):
+        k = self.__key(pt)
+        if not (k in self.events):
+            self.events[k] = []
+            self.event_pieces[k] = []
+            heapq.heappush(self.queue, (pt[0], pt[1], k))
+        return k
+
+    def __find_new_event(self, p1, p2, pt):
+        if p1.idx == p2.idx:
+            return
+        for ipt in p1.intersections(p2, self.eps):
+            if ipt[0]>pt[0]+self.eps or (abs(ipt[0]-pt[0])<=self.eps and ipt[1]>pt[1]+self.eps):
+                self.event_pieces[self.__push_event(ipt)] += [p1, p2]
+
+    # index of the first piece in status with y at x not less than y
+    def __lower_bound(self, x, y):
+        lo = 0
+        hi = len(self.status)
+        while lo<hi:
+            mid = (lo+hi)//2
+            if self.status[mid].y_at(x)<y:
+                lo = mid+1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, ignore_endpoints=False):
+        dbgfname()
+        self.queue = []
+        self.events = {}
+        # pieces known to pass through an event point: the ones ending
+        # there and the ones whose intersection made the event. y_at is
+        # steep near vertical tangents of arcs, so the search by y alone
+        # can miss them.
+        self.event_pieces = {}
+        self.status = []
+        found = {}
+        eps = self.eps
+        for p in self.pieces:
+            self.events[self.__push_event(p.left)].append(p)
+            self.event_pieces[self.__push_event(p.right)].append(p)
+
+        while len(self.queue)>0:
+            x, y, k = heapq.heappop(self.queue)
+            pt = (x, y)
+            upper = self.events.pop(k)
+            known = self.event_pieces.pop(k)
+            lo = self.__lower_bound(x, y-eps)
+            hi = self.__lower_bound(x, y+eps)
+            while hi<len(self.status) and self.status[hi].y_at(x)<=y+eps:
+                hi += 1
+            known_ids = set()
+            for p in known:
+                if id(p) in known_ids:
+                    continue
+                try:
+                    i = self.status.index(p)
+                except ValueError:
+                    continue
+                known_ids.add(id(p))
+                lo = min(lo, i)
+                hi = max(hi, i+1)
+            through = self.status[lo:hi]
+            at_pt = [p for p in through if id(p) in known_ids or abs(p.y_at(x)-y)<=eps]
+            at_ids = set([id(p) for p in at_pt])
+            cont = [p for p in through if not (id(p) in at_ids) or p.right[0]>x+eps or (abs(p.right[0]-x)<=eps and p.right[1]>y+eps)]
+            cont = [p for p in cont if self.__key(p.right) != k]
+
+            involved = upper+at_pt
+            idxs = set([p.idx for p in involved])
+            if len(idxs)>1:
+                for a in involved:
+                    for b in involved:
+                        if a.idx<b.idx:
+                            found.setdefault((a.idx, b.idx), []).append(pt)
+
+            # pieces through the event point leave it in order of slope,
+            # the others found between them keep their place by y
+            new = cont+upper
+            new.sort(key=lambda p: (y if (id(p) in at_ids or p.left[0] == x) else p.y_at(x), p.slope_at(x)))
+            self.status[lo:hi] = new
+            if len(new) == 0:
+                if lo>0 and lo<len(self.status):
+                    self.__find_new_event(self.status[lo-1], self.status[lo], pt)
+            else:
+                if lo>0:
+                    self.__find_new_event(self.status[lo-1], self.status[lo], pt)
+                last = lo+len(new)
+                if last<len(self.status):
+                    self.__find_new_event(self.status[last-1], self.status[last], pt)
+
+        debug("  pieces: "+str(len(self.pieces)))
+        return self.__unique(found, ignore_endpoints)
+
+    # found points of every pair rotated back, one per eps cell
+    def __unique(self, found, ignore_endpoints):
+        intersections = []
+        for (i, j), pts in sorted(found.items()):
+            seen = set()
+            for rpt in pts:
+                pt = self.__rotate(rpt, -self.sina)
+                k = self.__key(pt)
+                if k in seen:
+                    continue
+                seen.add(k)
+                if ignore_endpoints and self.__is_endpoint(i, pt) and self.__is_endpoint(j, pt):
+                    continue
+                intersections.append((i, j, pt))
+        debug("  intersections: "+str(len(intersections)))
+        return intersections
+
+    # every pair of pieces tested directly, O(n^2), reference for find
+    def find_brute(self, ignore_endpoints=False):
+        found = {}
+        for a in range(len(self.pieces)):
+            for b in range(a+1, len(self.pieces)):
+                p1 = self.pieces[a]
+                p2 = self.pieces[b]
+                if p1.idx == p2.idx:
+                    continue
+                i, j = min(p1.idx, p2.idx), max(p1.idx, p2.idx)
+                for pt in p1.intersections(p2, self.eps):
+                    found.setdefault((i, j), []).append(pt)
+        return self.__unique(found, ignore_endpoints)
+
+    def __is_endpoint(self, idx, pt):
+        e = self.elements[idx]
+        if type(e).__name__ == "ECircle":
+            return False
+        tol = max(self.eps*100, 1e-6)
+        return pt_to_pt_dist(e.start, pt)<tol or pt_to_pt_dist(e.end, pt)<tol
+
+def find_all_intersections(elements, ignore_endpoints=False):
+    return SweepLine(elements).find(ignore_endpoints)
+
+
+# Pairs (a, b) of ids from two lists of (key, id) entries with equal keys,
+# yielded in chunks of about max_pairs pairs to bound memory
+def key_pairs(keys_a, ids_a, keys_b, ids_b, max_pairs=1000000):
+    order = np.argsort(keys_b, kind="mergesort")
+    keys_b = keys_b[order]
+    ids_b = ids_b[order]
+    lo = np.searchsorted(keys_b, keys_a, "left")
+    cnt = np.searchsorted(keys_b, keys_a, "right")-lo
+    csum = np.cumsum(cnt)
+    first = 0
+    while first<len(keys_a):
+        last = max(int(np.searchsorted(csum, csum[first]-cnt[first]+max_pairs, "right")), first+1)
+        c = cnt[first:last]
+        total = c.sum()
+        a = np.repeat(ids_a[first:last], c)
+        offs = np.arange(total)-np.repeat(np.cumsum(c)-c, c)
+        b = ids_b[np.repeat(lo[first:last], c)+offs]
+        yield a, b
+        first = last
+
+# (key, id) entries of all grid cells covered by boxes mins[i]..maxs[i]
+def box_cells(mins, maxs, origin, cell, nx):
+    ix0 = np.floor((mins[:, 0]-origin[0])/cell).astype(np.int64)
+    iy0 = np.floor((mins[:, 1]-origin[1])/cell).astype(np.int64)
+    w = np.floor((maxs[:, 0]-origin[0])/cell).astype(np.int64)-ix0+1
+    h = np.floor((maxs[:, 1]-origin[1])/cell).astype(np.int64)-iy0+1
+    cnt = w*h
+    ids = np.repeat(np.arange(len(mins)), cnt)
+    k = np.arange(cnt.sum())-np.repeat(np.cumsum(cnt)-cnt, cnt)
+    wr = np.repeat(w, cnt)
+    cx = np.repeat(ix0, cnt)+k%wr
+    cy = np.repeat(iy0, cnt)+k//wr
+    return cy*nx+cx, ids
+
+# All intersections of segments starts[i]->ends[i] with integer valued
+# coordinates, candidates are taken from a uniform grid and tested in one
+# vectorized pass. Products of coordinates stay below 2**53 for coordinates
+# up to ~6e7, so the tests are exact. Touching at endpoints of both segments
+# is not reported, or with next_ids (index of the segment following each one
+# in its loop) only the joints between following segments are skipped.
+# Returns arrays i, j (i<j) and the (K, 2) rounded points.
+def segments_intersections(starts, ends, next_ids=None):
+    n = len(starts)
+    if n<2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0, 2))
+    mins = np.minimum(starts, ends)
+    maxs = np.maximum(starts, ends)
+    origin = mins.min(axis=0)
+    extent = (maxs.max(axis=0)-origin).max()
+    cell = max(extent/math.sqrt(n), 1.0)
+    nx = int(extent/cell)+2
+    keys, ids = box_cells(mins, maxs, origin, cell, nx)
+    pairs = []
+    for a, b in key_pairs(keys, ids, keys, ids):
+        sel = a<b
+        pairs.append(np.unique(a[sel]*n+b[sel]))
+    pairs = np.unique(np.concatenate(pairs))
+    a = pairs//n
+    b = pairs%n
+    # boxes have to overlap
+    sel = np.all(mins[a]<=maxs[b], axis=1) & np.all(mins[b]<=maxs[a], axis=1)
+    a = a[sel]
+    b = b[sel]
+
+    p = starts[a]
+    r = ends[a]-p
+    q = starts[b]
+    s = ends[b]-q
+    qp = q-p
+    d = r[:, 0]*s[:, 1]-r[:, 1]*s[:, 0]
+    tn = qp[:, 0]*s[:, 1]-qp[:, 1]*s[:, 0]
+    un = qp[:, 0]*r[:, 1]-qp[:, 1]*r[:, 0]
+    sd = np.sign(d)
+    ad = np.abs(d)
+    crossing = (d != 0) & (tn*sd>=0) & (tn*sd<=ad) & (un*sd>=0) & (un*sd<=ad)
+    t = tn[crossing]/d[crossing]
+    res_a = [a[crossing]]
+    res_b = [b[crossing]]
+    res_pts = [np.round(p[crossing]+r[crossing]*t[:, None])]
+
+    # collinear overlaps, endpoints of one segment laying on the other
+    col = (d == 0) & (un == 0)
+    if col.any():
+        ca, cb = a[col], b[col]
+        for sa, sb, pts in ((ca, cb, starts[cb]), (ca, cb, ends[cb]), (cb, ca, starts[ca]), (cb, ca, ends[ca])):
+            ss = starts[sa]
+            v = ends[sa]-ss
+            proj = ((pts-ss)*v).sum(axis=1)
+            inside = (proj>=0) & (proj<=(v*v).sum(axis=1))
+            res_a.append(np.minimum(sa, sb)[inside])
+            res_b.append(np.maximum(sa, sb)[inside])
+            res_pts.append(pts[inside])
+
+    ia = np.concatenate(res_a)
+    ib = np.concatenate(res_b)
+    pts = np.concatenate(res_pts).reshape(-1, 2)
+    if next_ids is None:
+        at_a = np.all(pts == starts[ia], axis=1) | np.all(pts == ends[ia], axis=1)
+        at_b = np.all(pts == starts[ib], axis=1) | np.all(pts == ends[ib], axis=1)
+        sel = ~(at_a & at_b)
+    else:
+        joint_ab = (next_ids[ia] == ib) & np.all(pts == ends[ia], axis=1)
+        joint_ba = (next_ids[ib] == ia) & np.all(pts == ends[ib], axis=1)
+        sel = ~(joint_ab | joint_ba)
+    return ia[sel], ib[sel], pts[sel]
+
+# Nonzero rule winding numbers of (N, 2) points against segments
+# starts[i]->ends[i], counterclockwise loops count +1. Segments are bucketed
+# into horizontal bands so every point is tested only against segments
+# crossing its band.
+def pts_winding_numbers(pts, starts, ends):
+    pts = np.asarray(pts, dtype=float).reshape(-1, 2)
+    wn = np.zeros(len(pts), dtype=np.int64)
+    if len(starts) == 0 or len(pts) == 0:
+        return wn
+    ymin = np.minimum(starts[:, 1], ends[:, 1])
+    ymax = np.maximum(starts[:, 1], ends[:, 1])
+    oy = min(ymin.min(), pts[:, 1].min())
+    h = max((max(ymax.max(), pts[:, 1].max())-oy)/math.sqrt(len(starts)), 1e-9)
+    b0 = np.floor((ymin-oy)/h).astype(np.int64)
+    cnt = np.floor((ymax-oy)/h).astype(np.int64)-b0+1
+    seg_ids = np.repeat(np.arange(len(starts)), cnt)
+    seg_keys = np.repeat(b0, cnt)+np.arange(cnt.sum())-np.repeat(np.cumsum(cnt)-cnt, cnt)
+    pt_keys = np.floor((pts[:, 1]-oy)/h).astype(np.int64)
+    for pi, si in key_pairs(pt_keys, np.arange(len(pts)), seg_keys, seg_ids):
+        p = pts[pi]
+        s = starts[si]
+        e = ends[si]
+        is_left = (e[:, 0]-s[:, 0])*(p[:, 1]-s[:, 1])-(p[:, 0]-s[:, 0])*(e[:, 1]-s[:, 1])
+        up = (s[:, 1]<=p[:, 1]) & (e[:, 1]>p[:, 1]) & (is_left>0)
+        down = (e[:, 1]<=p[:, 1]) & (s[:, 1]>p[:, 1]) & (is_left<0)
+        w = up.astype(np.int64)-down.astype(np.int64)
+        wn += np.bincount(pi, weights=w, minlength=len(pts)).astype(np.int64)
+    return wn
+
+def polygon_area(pts):
+    a = 0
+    for i in range(len(pts)):
+        a += pts[i-1][0]*pts[i][1]-pts[i][0]*pts[i-1][1]
+    return a/2.0
+
+# Polygon offsetting on fixed point coordinates. Loops are lists of (x, y)
+# without repeating the first point, the region lays on the left of every
+# loop (counterclockwise outlines, clockwise holes). Positive delta grows
+# the region. Every vertex is offset along the normals of its edges, gaps on
+# convex corners are closed with arcs within arc_tolerance and overlapping
+# corners are connected through the original vertex. The raw loops are
+# then split at their self-intersections and only pieces bounding the
+# positive winding region are kept and stitched back into loops, the same
+# union cleanup Clipper does.
+class PolygonOffset:
+    def __init__(self, loops, arc_tolerance=0.01, scale=10000.0):
+        self.arc_tolerance = arc_tolerance
+        self.scale = scale
+        self.loops = []
+        for loop in loops:
+            # vertices are kept unrounded so the corner angles are exact,
+            # points falling on the same fixed point position are merged
+            pts = []
+            for pt in loop:
+                spt = (pt[0]*scale, pt[1]*scale)
+                if len(pts) == 0 or self.__round_pt(pts[-1]) != self.__round_pt(spt):
+                    pts.append(spt)
+            while len(pts)>1 and self.__round_pt(pts[0]) == self.__round_pt(pts[-1]):
+                pts.pop()
+            if len(pts)>=3:
+                self.loops.append(pts)
+
+    def __round_pt(self, pt):
+        return (int(round(pt[0])), int(round(pt[1])))
+
+    def __dedup(self, pts):
+        out = []
+        for pt in pts:
+            if len(out) == 0 or out[-1] != pt:
+                out.append(pt)
+        while len(out)>1 and out[0] == out[-1]:
+            out.pop()
+        return out
+
+    def __dist(self, a, b):
+        return math.sqrt((b[0]-a[0])**2+(b[1]-a[1])**2)
+
+    def __unit_normal(self, a, b):
+        dx = b[0]-a[0]
+        dy = b[1]-a[1]
+        l = math.sqrt(dx*dx+dy*dy)
+        return (dy/l, -dx/l)
+
+    def __raw_offset(self, pts, d):
+        out = []
+        n = len(pts)
+        tol = self.arc_tolerance*self.scale
+        if tol<abs(d):
+            step = 2*math.acos(1-tol/abs(d))
+        else:
+            step = math.pi/2
+        for i in range(n):
+            prev = pts[i-1]
+            p = pts[i]
+            nxt = pts[(i+1)%n]
+            n1 = self.__unit_normal(prev, p)
+            n2 = self.__unit_normal(p, nxt)
+            q1 = (p[0]+n1[0]*d, p[1]+n1[1]*d)
+            q2 = (p[0]+n2[0]*d, p[1]+n2[1]*d)
+            sin_a = n1[0]*n2[1]-n1[1]*n2[0]
+            cos_a = n1[0]*n2[0]+n1[1]*n2[1]
+            out.append(q1)
+            if cos_a>0 and abs(sin_a)<1e-9:
+                continue
+            if sin_a*d>0 and cos_a>0 and abs(d)*(1/math.sqrt((1+cos_a)/2)-1)<=tol:
+                # gap small enough to be closed by the miter point
+                out.pop()
+                k = d/(1+cos_a)
+                out.append((p[0]+(n1[0]+n2[0])*k, p[1]+(n1[1]+n2[1])*k))
+                continue
+            if sin_a*d>0 or (cos_a<=0 and abs(sin_a)<1e-9):
+                a1 = math.atan2(n1[1]*d, n1[0]*d)
+                sweep = abs(math.atan2(sin_a, cos_a))
+                if d<0:
+                    sweep = -sweep
+                steps = int(math.ceil(abs(sweep)/step))
+                for k in range(1, steps):
+                    a = a1+sweep*k/steps
+                    out.append((p[0]+abs(d)*math.cos(a), p[1]+abs(d)*math.sin(a)))
+            elif 2*abs(d)*abs(sin_a)<=(1+cos_a)*min(self.__dist(prev, p), self.__dist(p, nxt)):
+                # trimmed at the miter point when both edges keep their
+                # direction
+                out.pop()
+                k = d/(1+cos_a)
+                out.append((p[0]+(n1[0]+n2[0])*k, p[1]+(n1[1]+n2[1])*k))
+                continue
+            elif cos_a<0.99:
+                # going through the original vertex keeps the negative
+                # region of sharp corners closed, nearly collinear corners
+                # of short edges are just connected
+                out.append(p)
+            out.append(q2)
+        return self.__dedup([(int(round(pt[0])), int(round(pt[1]))) for pt in out])
+
+    # splits loops at self-intersections and keeps pieces with zero winding
+    # on their right
+    def __clean(self, raws):
+        dbgfname()
+        starts = []
+        ends = []
+        next_ids = []
+        for pts in raws:
+            first = len(starts)
+            starts += pts
+            ends += pts[1:]+pts[:1]
+            next_ids += list(range(first+1, len(starts)))+[first]
+        starts = np.array(starts, dtype=float).reshape(-1, 2)
+        ends = np.array(ends, dtype=float).reshape(-1, 2)
+        ia, ib, ipts = segments_intersections(starts, ends, np.array(next_ids, dtype=np.int64))
+
+        splits = {}
+        cuts = set()
+        for i, j, pt in zip(ia.tolist(), ib.tolist(), ipts.tolist()):
+            pt = (int(pt[0]), int(pt[1]))
+            cuts.add(pt)
+            splits.setdefault(i, []).append(pt)
+            splits.setdefault(j, []).append(pt)
+
+        # pieces between cut points, each with the raw edge its first
+        # segment lays on
+        runs = []
+        closed = []
+        idx = 0
+        for pts in raws:
+            loop = []
+            edge_of = []
+            for k, s in enumerate(pts):
+                loop.append(s)
+                edge_of.append(idx)
+                if idx in splits:
+                    e = pts[(k+1)%len(pts)]
+                    v = (e[0]-s[0], e[1]-s[1])
+                    inner = [pt for pt in set(splits[idx]) if pt != s and pt != e]
+                    inner.sort(key=lambda pt: (pt[0]-s[0])*v[0]+(pt[1]-s[1])*v[1])
+                    loop += inner
+                    edge_of += [idx]*len(inner)
+                idx += 1
+            cut_ids = [k for k, pt in enumerate(loop) if pt in cuts]
+            if len(cut_ids) == 0:
+                closed.append((loop, edge_of[0]))
+                continue
+            first = cut_ids[0]
+            loop = loop[first:]+loop[:first+1]
+            edge_of = edge_of[first:]+edge_of[:first]
+            run = [loop[0]]
+            run_edge = edge_of[0]
+            for k, pt in enumerate(loop[1:]):
+                run.append(pt)
+                if pt in cuts:
+                    runs.append((run, run_edge))
+                    run = [pt]
+                    if k+1<len(edge_of):
+                        run_edge = edge_of[k+1]
+
+        # cut points are rounded, so the side of a piece is tested next to
+        # the raw edge it came from
+        test_pts = []
+        for piece, i in closed+runs:
+            a = piece[0]
+            b = piece[1]
+            s = starts[i]
+            v = ends[i]-s
+            m = ((a[0]+b[0])/2.0, (a[1]+b[1])/2.0)
+            t = ((m[0]-s[0])*v[0]+(m[1]-s[1])*v[1])/(v[0]*v[0]+v[1]*v[1])
+            n = self.__unit_normal(s, ends[i])
+            test_pts.append((s[0]+v[0]*t+n[0]*1e-3, s[1]+v[1]*t+n[1]*1e-3))
+        wn = pts_winding_numbers(test_pts, starts, ends)
+
+        result = [loop for (loop, i), w in zip(closed, wn[:len(closed)]) if w == 0]
+        kept = []
+        tiny = []
+        for (run, i), w in zip(runs, wn[len(closed):]):
+            if self.__dist(run[0], run[-1])<3 and sum([self.__dist(run[k], run[k+1]) for k in range(len(run)-1)])<3:
+                tiny.append(run)
+            elif w == 0:
+                kept.append(run)
+        # sides of pieces a few units long are not reliable next to rounded
+        # cut points, they are kept only where they close a gap between
+        # pieces
+        balance = {}
+        for run in kept:
+            balance[run[0]] = balance.get(run[0], 0)-1
+            balance[run[-1]] = balance.get(run[-1], 0)+1
+        for run in tiny:
+            if balance.get(run[0], 0)>0 and balance.get(run[-1], 0)<0:
+                kept.append(run)
+                balance[run[0]] -= 1
+                balance[run[-1]] += 1
+        by_start = {}
+        for k, run in enumerate(kept):
+            by_start.setdefault(run[0], []).append(k)
+        used = [False]*len(kept)
+        for k in range(len(kept)):
+            if used[k]:
+                continue
+            loop = []
+            cur = k
+            while cur != None and not used[cur]:
+                used[cur] = True
+                loop += kept[cur][:-1]
+                end = kept[cur][-1]
+                if end == loop[0]:
+                    break
+                cur = None
+                for c in by_start.get(end, []):
+                    if not used[c]:
+                        cur = c
+                        break
+            if cur == None:
+                debug("  open piece left after cleanup, dropped")
+                continue
+            result.append(loop)
+        debug("  segments: "+str(len(starts))+" intersections: "+str(len(ia))+" loops: "+str(len(result)))
+        min_area = (self.arc_tolerance*self.scale)**2
+        return [loop for loop in result if len(loop)>=3 and abs(polygon_area(loop))>min_area]
+
+    def offset(self, delta):
+        dbgfname()
+        d = delta*self.scale
+        if len(self.loops) == 0:
+            return []
+        # a loop shrinking by more than the radius of the circle of its area
+        # vanishes, its raw offset would only collapse into a knot of
+        # intersections
+        loops = []
+        for pts in self.loops:
+            area = polygon_area(pts)
+            if area*d<0 and abs(d)>=math.sqrt(abs(area)/math.pi):
+                continue
+            loops.append(pts)
+        if len(loops) == 0:
+            return []
+        raws = [self.__raw_offset(pts, d) for pts in loops]
+        raws = [pts for pts in raws if len(pts)>=3]
+        return [[(pt[0]/self.scale, pt[1]/self.scale) for pt in loop] for loop in self.__clean(raws)]
+
+# Loops given clockwise are reversed for PolygonOffset and delta negated,
+# so a positive delta is always on the right of the loop direction, and
+# the result is reversed back to the direction of the input.
+def offset_polygons(loops, delta, arc_tolerance=0.01):
+    if sum([polygon_area(pts) for pts in loops]) >= 0:
+        return PolygonOffset(loops, arc_tolerance).offset(delta)
+    loops = [list(reversed(pts)) for pts in loops]
+    return [list(reversed(pts)) for pts in PolygonOffset(loops, arc_tolerance).offset(-delta)]
+
+# center of the circle through points a, b, c or None when they are
+# collinear
+def circle_through_pts(a, b, c):
+    bx = b[0]-a[0]
+    by = b[1]-a[1]
+    cx = c[0]-a[0]
+    cy = c[1]-a[1]
+    d = 2*(bx*cy-by*cx)
+    if abs(d)<1e-12:
+        return None
+    b2 = bx*bx+by*by
+    c2 = cx*cx+cy*cy
+    return (a[0]+(cy*b2-by*c2)/d, a[1]+(bx*c2-cx*b2)/d)
+
+# largest j' >= j for which fits(i, j') holds, found by doubling the step
+# and bisecting the last one, fits is expected to hold up to some index
+def grow_run(fits, i, j, n):
+    step = 1
+    while j+step<n and fits(i, j+step):
+        j += step
+        step *= 2
+    while step>1:
+        step //= 2
+        if j+step<n and fits(i, j+step):
+            j += step
+    return j
+
+# Fits the polyline pts (N, 2) with lines and arcs within tolerance.
+# Returns pieces (i, j, center, ccw) replacing pts[i]..pts[j], center is
+# None for a straight line. An arc has to replace at least min_segments
+# segments turning the same way and sweeps at most max_sweep radians, so R
+# format arcs stay well conditioned. Every piece is grown greedily by
+# doubling and bisection of its end index, the fit tests are vectorized.
+def fit_polyline_arcs(pts, tolerance, min_segments=3, max_sweep=math.pi/2):
+    pts = np.asarray(pts, dtype=float).reshape(-1, 2)
+    n = len(pts)
+
+    def line_fits(i, j):
+        seg = pts[i:j+1]
+        u = pts[j]-pts[i]
+        l = math.sqrt(u[0]*u[0]+u[1]*u[1])
+        if l<1e-12:
+            return False
+        u = u/l
+        rel = seg-pts[i]
+        dist = np.abs(rel[:, 0]*u[1]-rel[:, 1]*u[0])
+        proj = rel[:, 0]*u[0]+rel[:, 1]*u[1]
+        return dist.max()<=tolerance and np.all(np.diff(proj)>=-1e-9)
+
+    def arc_fit(i, j):
+        c = circle_through_pts(pts[i], pts[(i+j)//2], pts[j])
+        if c == None:
+            return None
+        rel = pts[i:j+1]-c
+        r = math.sqrt(rel[0, 0]**2+rel[0, 1]**2)
+        if np.abs(np.sqrt((rel**2).sum(axis=1))-r).max()>tolerance:
+            return None
+        cross = rel[:-1, 0]*rel[1:, 1]-rel[:-1, 1]*rel[1:, 0]
+        dot = (rel[:-1]*rel[1:]).sum(axis=1)
+        angles = np.arctan2(cross, dot)
+        if not (np.all(angles>0) or np.all(angles<0)):
+            return None
+        if abs(angles.sum())>max_sweep:
+            return None
+        half_chord = np.sqrt(((pts[i+1:j+1]-pts[i:j])**2).sum(axis=1))/2.0
+        sagitta = r-np.sqrt(np.maximum(r*r-half_chord**2, 0))
+        if sagitta.max()>tolerance:
+            return None
+        return (float(c[0]), float(c[1])), bool(angles[0]>0)
+
+    pieces = []
+    i = 0
+    while i<n-1:
+        jl = grow_run(line_fits, i, i+1, n)
+        ja = i
+        if i+min_segments<n and arc_fit(i, i+min_segments) != None:
+            ja = grow_run(lambda a, b: arc_fit(a, b) != None, i, i+min_segments, n)
+        if ja>jl:
+            c, ccw = arc_fit(i, ja)
+            pieces.append((i, ja, c, ccw))
+            i = ja
+        else:
+            pieces.append((i, jl, None, None))
+            i = jl
+    return pieces
+
+# Orders tasks with entry and exit points (N, 2) so that the moves from
+# start to the first entry and from every exit to the next entry are short.
+# A nearest neighbour tour is improved by 2-opt moves reversing the order of
+# a stretch of tasks, each task keeps its own direction, so a move is
+# evaluated with prefix sums of the links in both directions. Returns the
+# order as a list of indices.
+def order_tasks(entries, exits, start):
+    entries = np.asarray(entries, dtype=float).reshape(-1, 2)
+    exits = np.asarray(exits, dtype=float).reshape(-1, 2)
+    n = len(entries)
+    if n == 0:
+        return []
+    left = np.ones(n, dtype=bool)
+    order = []
+    pos = (start[0], start[1])
+    for k in range(n):
+        d = np.hypot(entries[:, 0]-pos[0], entries[:, 1]-pos[1])
+        d[~left] = np.inf
+        i = int(np.argmin(d))
+        order.append(i)
+        left[i] = False
+        pos = exits[i]
+    order = np.array(order)
+
+    improved = True
+    while improved:
+        improved = False
+        for i in range(n-1):
+            en = entries[order]
+            ex = exits[order]
+            fwd = np.hypot(en[1:, 0]-ex[:-1, 0], en[1:, 1]-ex[:-1, 1])
+            rev = np.hypot(en[:-1, 0]-ex[1:, 0], en[:-1, 1]-ex[1:, 1])
+            f = np.concatenate(([0], np.cumsum(fwd)))
+            r = np.concatenate(([0], np.cumsum(rev)))
+            prev = (start[0], start[1]) if i == 0 else ex[i-1]
+            j = np.arange(i+1, n)
+            has_next = j+1<n
+            nxt = en[np.minimum(j+1, n-1)]
+            tail_old = np.where(has_next, np.hypot(nxt[:, 0]-ex[j, 0], nxt[:, 1]-ex[j, 1]), 0)
+            tail_new = np.where(has_next, np.hypot(nxt[:, 0]-ex[i, 0], nxt[:, 1]-ex[i, 1]), 0)
+            old = math.hypot(en[i, 0]-prev[0], en[i, 1]-prev[1])+f[j]-f[i]+tail_old
+            new = np.hypot(en[j, 0]-prev[0], en[j, 1]-prev[1])+r[j]-r[i]+tail_new
+            gain = old-new
+            k = int(np.argmax(gain))
+            if gain[k]>1e-9:
+                order[i:j[k]+1] = order[i:j[k]+1][::-1].copy()
+                improved = True
+    return order.tolist()
+
 if __name__=="__main__":
     au = ArcUtils((0, 0), 1, -10*math.pi/180.0, 300*math.pi/180.0)
     
@@ -483,3 +1519,24 @@ if __name__=="__main__":
     print "checking angle", angle, au.check_angle_in_range(angle*math.pi/180.0)
     angle = 301
     print "checking angle", angle, au.check_angle_in_range(angle*math.pi/180.0)
+
+    # sweep line against testing every pair, random lines and arcs
+    import random
+    from elements import ELine, EArc
+    random.seed(0)
+    missed = 0
+    extra = 0
+    for run in range(200):
+        els = []
+        for k in range(8):
+            if random.random()<0.5:
+                els.append(ELine([random.uniform(0, 50), random.uniform(0, 50), 0], [random.uniform(0, 50), random.uniform(0, 50), 0], None))
+            else:
+                sa = random.uniform(0, 360)
+                els.append(EArc(center=[random.uniform(0, 50), random.uniform(0, 50), 0], radius=random.uniform(2, 20), startangle=sa, endangle=sa+random.uniform(20, 300), lt=None, turnaround=random.random()<0.3))
+        sl = SweepLine(els)
+        found = set([(i, j, round(pt[0], 5), round(pt[1], 5)) for i, j, pt in sl.find()])
+        brute = set([(i, j, round(pt[0], 5), round(pt[1], 5)) for i, j, pt in sl.find_brute()])
+        missed += len(brute-found)
+        extra += len(found-brute)
+    print "sweep line vs brute force, missed:", missed, "extra:", extra
@@ -0,0 +1,194 @@
+from collections import deque
+
+from logging import debug, info, warning, error, critical
+from util import dbgfname
+
+# Rough memory estimates for the undo budget: every command costs
+# COMMAND_COST and every element it keeps alive ELEMENT_COST bytes
+COMMAND_COST = 256
+ELEMENT_COST = 512
+
+def elements_count(obj):
+    n = 0
+    for attr in ["elements", "ordered_elements", "draw_list"]:
+        lst = getattr(obj, attr, None)
+        if lst != None:
+            n += len(lst)
+    return n
+
+# Commands change the live state and know how to revert the change, undo
+# touches only what the command changed.
+class Command(object):
+    def do(self):
+        pass
+
+    def undo(self):
+        pass
+
+    def size(self):
+        return COMMAND_COST
+
+class AddToolOperations(Command):
+    def __init__(self, state, ops):
+        self.state = state
+        self.ops = ops
+
+    def do(self):
+        self.state.tool_operations += self.ops
+
+    def undo(self):
+        for op in self.ops:
+            self.state.tool_operations.remove(op)
+
+    def size(self):
+        return COMMAND_COST+sum([elements_count(op) for op in self.ops])*ELEMENT_COST
+
+class RemoveToolOperation(Command):
+    def __init__(self, state, op):
+        self.state = state
+        self.op = op
+        self.index = None
+
+    def do(self):
+        self.index = self.state.tool_operations.index(self.op)
+        del self.state.tool_operations[self.index]
+
+    def undo(self):
+        self.state.tool_operations.insert(self.index, self.op)
+
+    def size(self):
+        return COMMAND_COST+elements_count(self.op)*ELEMENT_COST
+
+class MoveToolOperation(Command):
+    def __init__(self, state, op, shift):
+        self.state = state
+        self.op = op
+        self.shift = shift
+
+    def __move(self, shift):
+        ops = self.state.tool_operations
+        idx = ops.index(self.op)
+        del ops[idx]
+        ops.insert(idx+shift, self.op)
+
+    def do(self):
+        self.__move(self.shift)
+
+    def undo(self):
+        self.__move(-self.shift)
+
+class RemovePath(Command):
+    def __init__(self, state, path):
+        self.state = state
+        self.path = path
+        self.index = None
+
+    def do(self):
+        self.index = self.state.paths.index(self.path)
+        del self.state.paths[self.index]
+
+    def undo(self):
+        self.state.paths.insert(self.index, self.path)
+
+    def size(self):
+        return COMMAND_COST+elements_count(self.path)*ELEMENT_COST
+
+# elements of the connected paths are taken out of the paths they were in
+# and the connected paths are added, undo puts the elements back in place
+class JoinElements(Command):
+    def __init__(self, state, connected_paths):
+        self.state = state
+        self.connected_paths = connected_paths
+        self.removed = []
+
+    def do(self):
+        joined = set()
+        for connected in self.connected_paths:
+            for e in connected.elements:
+                joined.add(id(e))
+        self.removed = []
+        for p in self.state.paths:
+            taken = [(i, e) for i, e in enumerate(p.elements) if id(e) in joined]
+            if len(taken) > 0:
+                p.elements[:] = [e for e in p.elements if not (id(e) in joined)]
+                self.removed.append((p, taken))
+        self.state.paths += self.connected_paths
+
+    def undo(self):
+        for connected in self.connected_paths:
+            self.state.paths.remove(connected)
+        for p, taken in self.removed:
+            for i, e in taken:
+                p.elements.insert(i, e)
+
+    def size(self):
+        return COMMAND_COST+sum([elements_count(p) for p in self.connected_paths])*ELEMENT_COST
+
+class ChangeSetting(Command):
+    def __init__(self, setting, value):
+        self.setting = setting
+        self.value = value
+        if setting.new_value != None:
+            self.old_value = setting.new_value
+        else:
+            self.old_value = setting.default
+
+    def do(self):
+        self.setting.set_value(self.value)
+
+    def undo(self):
+        self.setting.set_value(self.old_value)
+
+# Undo/redo stacks of commands. Commands above budget bytes are dropped,
+# oldest first, so the history stays bounded however long the session is.
+class History(object):
+    def __init__(self, budget):
+        self.budget = budget
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.used = 0
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack = []
+        self.used = 0
+
+    def __evict(self):
+        while self.used > self.budget and len(self.undo_stack) > 0:
+            cmd, cost = self.undo_stack.popleft()
+            self.used -= cost
+        while self.used > self.budget and len(self.redo_stack) > 0:
+            cmd, cost = self.redo_stack.pop(0)
+            self.used -= cost
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self.__evict()
+
+    def do(self, cmd):
+        dbgfname()
+        cmd.do()
+        for c, cost in self.redo_stack:
+            self.used -= cost
+        self.redo_stack = []
+        cost = cmd.size()
+        self.undo_stack.append((cmd, cost))
+        self.used += cost
+        self.__evict()
+        debug("  undo entries: "+str(len(self.undo_stack))+" used: "+str(self.used))
+
+    def undo(self):
+        if len(self.undo_stack) == 0:
+            return False
+        cmd, cost = self.undo_stack.pop()
+        cmd.undo()
+        self.redo_stack.append((cmd, cost))
+        return True
+
+    def redo(self):
+        if len(self.redo_stack) == 0:
+            return False
+        cmd, cost = self.redo_stack.pop()
+        cmd.do()
+        self.undo_stack.append((cmd, cost))
+        return True
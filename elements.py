@@ -1,5 +1,5 @@
 import math
-from calc_utils import AABB, CircleUtils, LineUtils, ArcUtils, PointUtils, vect_len, mk_vect
+from calc_utils import AABB, CircleUtils, LineUtils, ArcUtils, PointUtils, vect_len, mk_vect, normalize
 from tool_operation import TOEnum
 
 from logging import debug, info, warning, error, critical
@@ -152,6 +152,57 @@ class EArc(Element):
         self.operations[TOEnum.offset_follow] = True
         self.start_normal = None
         self.end_normal = None
+        self.linearized = {}
+
+    # Splits arc into lines with chord error not above tolerance (mm), so the
+    # number of lines depends on radius and sweep of the arc. Lines follow
+    # traversal direction (clockwise for turnaround arcs). Result is cached
+    # per tolerance as long as geometry of the arc doesn't change.
+    def linearize(self, tolerance=0.01):
+        geometry = (tuple(self.center), self.radius, self.startangle, self.endangle, tuple(self.start), tuple(self.end), self.is_turnaround)
+        if tolerance in self.linearized:
+            cached_geometry, lines = self.linearized[tolerance]
+            if cached_geometry == geometry:
+                return lines[:]
+
+        sa = self.startangle
+        da = self.get_sweep()
+        direction = -1 if self.is_turnaround else 1
+
+        if tolerance >= self.radius:
+            n_steps = 1
+        else:
+            max_step = 2*math.acos(1-tolerance/float(self.radius))
+            n_steps = max(int(math.ceil(da/max_step)), 1)
+
+        lines = []
+        s_pt = self.start
+        for i in range(1, n_steps):
+            a = sa+direction*i*da/n_steps
+            e_pt = (self.center[0]+math.cos(a)*self.radius, self.center[1]+math.sin(a)*self.radius)
+            lines.append(ELine(s_pt, e_pt, self.lt, self.color))
+            s_pt = e_pt
+        lines.append(ELine(s_pt, self.end, self.lt, self.color))
+        self.linearized[tolerance] = (geometry, lines)
+        return lines[:]
+
+    # angle covered when going from start to end, counterclockwise for
+    # normal arcs and clockwise for turnaround ones
+    def get_sweep(self):
+        if self.is_turnaround:
+            da = self.startangle-self.endangle
+        else:
+            da = self.endangle-self.startangle
+        if da < 0:
+            da += math.pi*2
+        return da
+
+    # unit tangent in traversal direction at point pt of the arc
+    def get_tangent(self, pt):
+        v = normalize(mk_vect(self.center, pt))
+        if self.is_turnaround:
+            return [v[1], -v[0], 0]
+        return [-v[1], v[0], 0]
 
     def to_line_sequence(self, precision):
         dbgfname()
@@ -168,7 +219,7 @@ class EArc(Element):
         converted_elements = []
 
         for i in range(1,n_steps):
-            a = sa+i*0.1
+            a = sa+i*precision
             e_pt = (self.center[0]+math.cos(a)*self.radius, self.center[1]+math.sin(a)*self.radius)
             ne = ELine(s_pt, e_pt, self.lt, self.color)
             debug("  angle: "+str(a)+" line: "+str(s_pt)+" "+str(e_pt))
@@ -277,6 +328,25 @@ class ECircle(Element):
         self.center = data["center"]
         self.color = data["color"]
 
+    # Splits circle into lines with chord error not above tolerance (mm),
+    # counterclockwise from start, as EArc.linearize does for arcs
+    def linearize(self, tolerance=0.01):
+        if tolerance >= self.radius:
+            n_steps = 3
+        else:
+            max_step = 2*math.acos(1-tolerance/float(self.radius))
+            n_steps = max(int(math.ceil(2*math.pi/max_step)), 3)
+
+        lines = []
+        s_pt = self.start
+        for i in range(1, n_steps):
+            a = i*2*math.pi/n_steps
+            e_pt = (self.center[0]+math.cos(a)*self.radius, self.center[1]+math.sin(a)*self.radius)
+            lines.append(ELine(s_pt, e_pt, self.lt, self.color))
+            s_pt = e_pt
+        lines.append(ELine(s_pt, self.end, self.lt, self.color))
+        return lines
+
     def draw_element(self, ctx):
         ctx.arc(self.center[0], self.center[1], self.radius, 0, math.pi*2)
 
@@ -295,6 +365,9 @@ class ECircle(Element):
     def get_aabb(self):
         cu = CircleUtils(self.center, self.radius)
         return cu.get_aabb()
+
+    def get_cu(self):
+        return CircleUtils(self.center, self.radius)
         
     def __repr__(self):
         return "<ECircle (center: "+str(self.center)+", r: "+str(self.radius)+")>\r\n"
@@ -336,6 +409,9 @@ class EPoint(Element):
     def get_aabb(self):
         pu = PointUtils(self.center)
         return pu.get_aabb()
+
+    def get_cu(self):
+        return PointUtils(self.center)
         
     def __repr__(self):
         return "<EPoint (center: "+str(self.center)+")>\r\n"
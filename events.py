@@ -6,13 +6,15 @@ import os
 
 from loader_dxf import DXFLoader
 from state import state, State
-from tool_op_drill import TODrill
+from tool_op_drill import TODrill, TOMultiDrill
 from tool_op_exact_follow import TOExactFollow
 from tool_op_offset_follow import TOOffsetFollow
 from tool_op_pocketing import TOPocketing
+from tool_operation import OrderEnum, order_tool_operations
 from calc_utils import AABB, OverlapEnum
 from path import Path
 from project import project
+from commands import History, AddToolOperations, RemoveToolOperation, MoveToolOperation, RemovePath, JoinElements, ChangeSetting
 
 from logging import debug, info, warning, error, critical
 from util import dbgfname
@@ -26,6 +28,7 @@ class EVEnum:
     save_project_click = "save_project_click"
     load_project = "load_project"
     save_project = "save_project"
+    compact_project_click = "compact_project_click"
     new_project_click = "new_project_click"
     quit_click = "quit_click"
     screen_left_press = "screen_left_press"
@@ -53,6 +56,8 @@ class EVEnum:
     paths_check_button_click = "paths_check_button_click"
     path_delete_button_click = "path_delete_button_click"
     tool_operation_delete_button_click = "tool_operation_delete_button_click"
+    undo_click = "undo_click"
+    redo_click = "redo_click"
 
 class EventProcessor(object):
     ee = EVEnum()
@@ -74,6 +79,7 @@ class EventProcessor(object):
             self.ee.save_project_click: self.save_project_click,
             self.ee.load_project: self.load_project,
             self.ee.save_project: self.save_project,
+            self.ee.compact_project_click: self.compact_project_click,
             self.ee.new_project_click: self.new_project_click,
             self.ee.quit_click: self.quit_click,
             self.ee.screen_left_press: self.screen_left_press,
@@ -101,7 +107,11 @@ class EventProcessor(object):
             self.ee.paths_check_button_click: self.paths_check_button_click,
             self.ee.path_delete_button_click: self.path_delete_button_click,
             self.ee.tool_operation_delete_button_click: self.tool_operation_delete_button_click,
+            self.ee.undo_click: self.undo_click,
+            self.ee.redo_click: self.redo_click,
         }
+        self.history = History(state.settings.undo_budget*1024*1024)
+        self.__apply_budget()
 
     def reset(self):
         self.selected_elements = []
@@ -156,7 +166,10 @@ class EventProcessor(object):
                 self.save_project_click(None)
 
         self.reset()
+        project.reset()
+        self.history.clear()
         state.set(State())
+        self.__apply_budget()
         self.push_event(self.ee.update_tool_operations_list, (None))
         self.push_event(self.ee.update_paths_list, (None))
         project.push_state(state)
@@ -204,24 +217,43 @@ class EventProcessor(object):
         file_path = args[0]
         if os.path.splitext(file_path)[1][1:].strip() != "ngc":
             file_path+=".ngc"
-        out = ""
-        out+=state.settings.default_pp.set_metric()
-        out+=state.settings.default_pp.set_absolute()
-        feedrate = state.settings.tool.get_feedrate()
-        debug("  feedrate: "+str(feedrate))
-        out+=state.settings.default_pp.set_feedrate(feedrate)
-        for p in state.tool_operations:
-            out+=p.get_gcode()
-        out+= state.settings.default_pp.move_to_rapid([0, 0, state.settings.tool.default_height])
-        f = open(file_path, "w")
-        f.write(out)
-        f.close()
+        # Chunks go straight to the buffered file as operations yield them.
+        # The program is written to a temporary file renamed over the target
+        # once complete, so a failing operation leaves no partial program.
+        tmp_path = file_path+".tmp"
+        f = open(tmp_path, "w", 65536)
+        done = False
+        try:
+            state.settings.default_pp.reset()
+            f.write(state.settings.default_pp.set_metric())
+            f.write(state.settings.default_pp.set_absolute())
+            feedrate = state.settings.tool.get_feedrate()
+            debug("  feedrate: "+str(feedrate))
+            f.write(state.settings.default_pp.set_feedrate(feedrate))
+            # each export starts at the origin, not where the previous one ended
+            state.settings.tool.current_position = [0, 0, state.settings.tool.default_height]
+            ops = state.tool_operations
+            if state.settings.op_order != OrderEnum.listed:
+                ops = order_tool_operations(ops, state.settings.tool.current_position, state.settings.op_order == OrderEnum.drills_first)
+            for p in ops:
+                f.writelines(p.get_gcode())
+            f.write(state.settings.default_pp.move_to_rapid([0, 0, state.settings.tool.default_height]))
+            f.close()
+            os.rename(tmp_path, file_path)
+            done = True
+        finally:
+            if not done:
+                f.close()
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
 
     def load_project(self, args):
         dbgfname()
         debug("  load project: "+str(args))
         project_path = args[0]
         project.load(project_path)
+        self.history.clear()
+        self.__apply_budget()
         self.mw.update_right_vbox()
 
     def save_project(self, args):
@@ -230,6 +262,12 @@ class EventProcessor(object):
         project_path = args[0]
         project.save(project_path)
 
+    # rewrites the project file with only the records the history uses
+    def compact_project_click(self, args):
+        dbgfname()
+        if not project.compact():
+            debug("  project is not saved, nothing to compact")
+
     def screen_left_press(self, args):
         dbgfname()
         debug("  press at:"+str(args))
@@ -313,11 +351,20 @@ class EventProcessor(object):
         dbgfname()
         debug("  drill tool click:"+str(args))
         debug("  "+str(self.selected_elements))
+        if len(self.selected_elements)>1:
+            # several holes become one operation with ordered holes
+            drl_op = TOMultiDrill(state, index=len(state.tool_operations))
+            if drl_op.apply(self.selected_elements, state.get_settings().get_material().get_thickness()):
+                self.history.do(AddToolOperations(state, [drl_op]))
+                self.push_event(self.ee.update_tool_operations_list, (None))
+                project.push_state(state)
+            self.mw.widget.update()
+            return
         for e in self.selected_elements:
             debug("  thickness:"+str(state.get_settings().get_material().get_thickness()))
             drl_op = TODrill(state, index=len(state.tool_operations))
             if drl_op.apply(e, state.get_settings().get_material().get_thickness()):
-                state.tool_operations.append(drl_op)
+                self.history.do(AddToolOperations(state, [drl_op]))
                 self.push_event(self.ee.update_tool_operations_list, (None))
                 project.push_state(state)
         debug("  "+str(state.tool_operations))
@@ -329,20 +376,17 @@ class EventProcessor(object):
         if self.selected_elements!=None:
             debug("  selected: "+str(self.selected_elements))
             p = Path(state, self.selected_elements, "path", state.settings.get_def_lt().name)
-            connected = p.mk_connected_path()
-            debug("  connected elements: "+str(connected))
-            if connected != None:
-                connected.name = connected.name+" "+str(len(sp))
+            connected_paths = p.mk_connected_paths()
+            debug("  connected paths: "+str(connected_paths))
+            if len(connected_paths) != 0:
                 self.deselect_all(None)
-                for e in connected.elements:
-                    for i, p in enumerate(sp):
-                        if e in sp[i].elements:
-                            sp[i].elements.remove(e)
-                sp.append(connected)
+                for i, connected in enumerate(connected_paths):
+                    connected.name = connected.name+" "+str(len(sp)+i)
+                self.history.do(JoinElements(state, connected_paths))
                 self.push_event(self.ee.update_paths_list, (None))
                 project.push_state(state)
-                return connected
-        return None
+                return connected_paths
+        return []
 
     def deselect_all(self, args):
         for e in self.selected_elements:
@@ -385,50 +429,64 @@ class EventProcessor(object):
     def exact_follow_tool_click(self, args):
         dbgfname()
         debug("  exact follow tool click: "+str(args))
-        connected = self.join_elements(None)
+        connected_paths = self.join_elements(None)
         debug("  selected path: "+str(self.selected_path))
-        if connected != None:
-            path_follow_op = TOExactFollow(state, index=len(state.tool_operations), depth=state.get_settings().get_material().get_thickness())
+        added = []
+        for connected in connected_paths:
+            path_follow_op = TOExactFollow(state, index=len(state.tool_operations)+len(added), depth=state.get_settings().get_material().get_thickness())
             if path_follow_op.apply(connected):
-                state.add_tool_operations([path_follow_op])
-                #state.tool_operations.append(path_follow_op)
-                self.push_event(self.ee.update_tool_operations_list, (None))
-                project.push_state(state)
+                added.append(path_follow_op)
+        if len(added) > 0:
+            self.history.do(AddToolOperations(state, added))
+            self.push_event(self.ee.update_tool_operations_list, (None))
+            project.push_state(state)
         self.mw.widget.update()
 
     def offset_follow_tool_click(self, args):
         dbgfname()
         debug("  offset follow tool click: "+str(args))
-        connected = self.join_elements(None)
+        connected_paths = self.join_elements(None)
         debug("  selected path: "+str(self.selected_path))
-        debug("  connected: "+str(connected))
-        if connected != None:
-            path_follow_op = TOOffsetFollow(state, index=len(state.tool_operations), depth=state.get_settings().get_material().get_thickness())
+        debug("  connected: "+str(connected_paths))
+        added = []
+        for connected in connected_paths:
+            path_follow_op = TOOffsetFollow(state, index=len(state.tool_operations)+len(added), depth=state.get_settings().get_material().get_thickness())
             if path_follow_op.apply(connected):
-                state.tool_operations.append(path_follow_op)
-                self.push_event(self.ee.update_tool_operations_list, (None))
-                project.push_state(state)
+                added.append(path_follow_op)
+        if len(added) > 0:
+            self.history.do(AddToolOperations(state, added))
+            self.push_event(self.ee.update_tool_operations_list, (None))
+            project.push_state(state)
         self.mw.widget.update()
 
     def pocket_tool_click(self, args):
         dbgfname()
         debug("  pocket tool click: "+str(args))
-        connected = self.join_elements(None)
+        connected_paths = self.join_elements(None)
         debug("  selected path: "+str(self.selected_path))
-        if connected != None:
-            pocket_op = TOPocketing(state, index=len(state.tool_operations), depth=state.get_settings().get_material().get_thickness())
+        added = []
+        for connected in connected_paths:
+            if not connected.get_closed():
+                continue
+            pocket_op = TOPocketing(state, index=len(state.tool_operations)+len(added), depth=state.get_settings().get_material().get_thickness())
             if pocket_op.apply(connected):
-                state.tool_operations.append(pocket_op)
-                self.push_event(self.ee.update_tool_operations_list, (None))
-                project.push_state(state)
+                added.append(pocket_op)
+        if len(added) > 0:
+            self.history.do(AddToolOperations(state, added))
+            self.push_event(self.ee.update_tool_operations_list, (None))
+            project.push_state(state)
         self.mw.widget.update()
 
     def update_settings(self, args):
         dbgfname()
         debug("  settings update: "+str(args))
-        new_value = args[0][1][0].get_value()
         setting = args[0][0]
-        setting.set_value(new_value)
+        if setting.type == "enum":
+            new_value = setting.options[args[0][1][0].get_active()]
+        else:
+            new_value = args[0][1][0].get_value()
+        self.history.do(ChangeSetting(setting, new_value))
+        self.__apply_budget()
         oldtool = state.get_tool()
         debug("  tool: "+str(oldtool))
         debug("  feedrate: "+str(oldtool.get_feedrate()))
@@ -449,9 +507,7 @@ class EventProcessor(object):
         debug("  cur idx: "+str(cur_idx))
         if cur_idx == 0:
             return
-        temp = self.selected_tool_operation
-        state.tool_operations.remove(self.selected_tool_operation)
-        state.tool_operations.insert(cur_idx-1, temp)
+        self.history.do(MoveToolOperation(state, self.selected_tool_operation, -1))
         self.push_event(self.ee.update_tool_operations_list, (None))
         project.push_state(state)
 
@@ -466,9 +522,7 @@ class EventProcessor(object):
         debug("  cur idx: "+str(cur_idx))
         if cur_idx == len(state.tool_operations)-1:
             return
-        temp = self.selected_tool_operation
-        state.tool_operations.remove(self.selected_tool_operation)
-        state.tool_operations.insert(cur_idx+1, temp)
+        self.history.do(MoveToolOperation(state, self.selected_tool_operation, 1))
         self.push_event(self.ee.update_tool_operations_list, (None))
         project.push_state(state)
 
@@ -527,7 +581,7 @@ class EventProcessor(object):
 
     def path_delete_button_click(self, args):
         if self.selected_path in state.paths:
-            state.paths.remove(self.selected_path)
+            self.history.do(RemovePath(state, self.selected_path))
             self.selected_path = None
             self.push_event(self.ee.update_paths_list, (None))
             project.push_state(state)
@@ -535,11 +589,42 @@ class EventProcessor(object):
 
     def tool_operation_delete_button_click(self, args):
         if self.selected_tool_operation in state.tool_operations:
-            state.tool_operations.remove(self.selected_tool_operation)
+            self.history.do(RemoveToolOperation(state, self.selected_tool_operation))
             self.selected_tool_operation = None
             self.push_event(self.ee.update_tool_operations_list, (None))
             project.push_state(state)
         self.mw.widget.update()
-        
+
+    # undo memory setting applies to both the undo stacks and the project
+    # history
+    def __apply_budget(self):
+        self.history.set_budget(state.settings.undo_budget*1024*1024)
+        project.set_budget(state.settings.undo_budget*1024*1024)
+
+    # undone objects may be selected or shown in the settings, so the
+    # selection is dropped and the lists and settings are rebuilt, the undo
+    # memory setting may have been undone too
+    def __history_changed(self):
+        self.deselect_all(None)
+        self.selected_path = None
+        self.selected_tool_operation = None
+        self.push_event(self.ee.update_paths_list, (None))
+        self.push_event(self.ee.update_tool_operations_list, (None))
+        self.mw.new_settings_vbox(None, None)
+        self.mw.update_right_vbox()
+        self.__apply_budget()
+        project.push_state(state)
+        self.mw.widget.update()
+
+    def undo_click(self, args):
+        dbgfname()
+        if self.history.undo():
+            self.__history_changed()
+
+    def redo_click(self, args):
+        dbgfname()
+        if self.history.redo():
+            self.__history_changed()
+
 ee = EVEnum()
 ep = EventProcessor()
@@ -1,6 +1,7 @@
 class TOSetting:
-    def __init__(self, type, min, max, default, display_name, parent_cb):
+    def __init__(self, type, min, max, default, display_name, parent_cb, options=None):
         self.type = type
+        self.options = options
         self.min = min
         self.max = max
         self.default = default
@@ -24,6 +24,10 @@ class MainWindow(object):
         self.file_item = gtk.MenuItem("_File")
         self.file_item.set_submenu(self.file_menu)
         self.menu_bar.append(self.file_item)
+        self.edit_menu = gtk.Menu()
+        self.edit_item = gtk.MenuItem("_Edit")
+        self.edit_item.set_submenu(self.edit_menu)
+        self.menu_bar.append(self.edit_item)
 
         agr = gtk.AccelGroup()
         self.window.add_accel_group(agr)
@@ -40,6 +44,8 @@ class MainWindow(object):
         key, mod = gtk.accelerator_parse("<Control>S")
         self.save_project_item.add_accelerator("activate", agr, key, mod, gtk.ACCEL_VISIBLE)
 
+        self.compact_project_item = gtk.MenuItem("Compact project")
+
         sep_export_import = gtk.SeparatorMenuItem()
         self.export_item = gtk.MenuItem("Export ...")
         self.import_item = gtk.MenuItem("Import ...")
@@ -48,21 +54,34 @@ class MainWindow(object):
         key, mod = gtk.accelerator_parse("<Control>Q")
         self.quit_item.add_accelerator("activate", agr, key, mod, gtk.ACCEL_VISIBLE)
 
+        self.undo_item = gtk.MenuItem("Undo")
+        key, mod = gtk.accelerator_parse("<Control>Z")
+        self.undo_item.add_accelerator("activate", agr, key, mod, gtk.ACCEL_VISIBLE)
+        self.redo_item = gtk.MenuItem("Redo")
+        key, mod = gtk.accelerator_parse("<Control><Shift>Z")
+        self.redo_item.add_accelerator("activate", agr, key, mod, gtk.ACCEL_VISIBLE)
+
         self.file_menu.append(self.new_project_item)
         self.file_menu.append(self.open_project_item)
         self.file_menu.append(self.save_project_item)
+        self.file_menu.append(self.compact_project_item)
         self.file_menu.append(sep_export_import)
         self.file_menu.append(self.import_item)
         self.file_menu.append(self.export_item)
         self.file_menu.append(sep_quit)
         self.file_menu.append(self.quit_item)
+        self.edit_menu.append(self.undo_item)
+        self.edit_menu.append(self.redo_item)
 
         self.import_item.connect("activate", lambda *args: ep.push_event(ee.load_click, args))
         self.export_item.connect("activate", lambda *args: ep.push_event(ee.save_click, args))
         self.new_project_item.connect("activate", lambda *args: ep.push_event(ee.new_project_click, args))
         self.open_project_item.connect("activate", lambda *args: ep.push_event(ee.load_project_click, args))
         self.save_project_item.connect("activate", lambda *args: ep.push_event(ee.save_project_click, args))
+        self.compact_project_item.connect("activate", lambda *args: ep.push_event(ee.compact_project_click, args))
         self.quit_item.connect("activate", lambda *args: ep.push_event(ee.quit_click, args))
+        self.undo_item.connect("activate", lambda *args: ep.push_event(ee.undo_click, args))
+        self.redo_item.connect("activate", lambda *args: ep.push_event(ee.redo_click, args))
 
         self.window_vbox = gtk.VBox(homogeneous=False, spacing=0)
         self.window_vbox.pack_start(self.menu_bar, expand=False, fill=False, padding=0)
@@ -123,6 +142,9 @@ class MainWindow(object):
             if s.type == "float":
                 w = self.__mk_labeled_spin(dct, s.display_name, s, None, s.default, s.min, s.max)
                 self.settings_vb.pack_start(w, expand=False, fill=False, padding=0)
+            elif s.type == "enum":
+                w = self.__mk_labeled_combo(dct, s.display_name, s, s.options, s.default)
+                self.settings_vb.pack_start(w, expand=False, fill=False, padding=0)
 
     def mk_question_dialog(self, question):
         md = gtk.Dialog(title=question, parent=self.window, flags=gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT)
@@ -236,6 +258,25 @@ class MainWindow(object):
         hbox.pack_start(spin, expand=True, fill=True, padding=0)
         return hbox
 
+    def __mk_labeled_combo(self, dct, mlabel, data=None, options=None, value=None):
+        hbox = gtk.HBox(homogeneous=False, spacing=0)
+        hbox.show()
+        dct["hbox"] = hbox
+        label = gtk.Label(mlabel)
+        label.show()
+        dct["label"] = label
+        combo = gtk.combo_box_new_text()
+        for o in options:
+            combo.append_text(o)
+        if value in options:
+            combo.set_active(options.index(value))
+        combo.connect("changed", lambda *args: ep.push_event(ee.update_settings, (data, args)))
+        combo.show()
+        dct["combo"] = combo
+        hbox.pack_start(label, expand=False, fill=False, padding=0)
+        hbox.pack_start(combo, expand=True, fill=True, padding=0)
+        return hbox
+
     def update_right_vbox(self):
         self.hbox.remove(self.hbox.children()[-1])
         children = self.right_vbox.children()
@@ -274,6 +315,21 @@ class MainWindow(object):
                     w = self.__mk_labeled_spin(dct, s.display_name, s, None, s.default, s.min, s.max)
                     self.right_vbox.pack_start(w, expand=False, fill=False, padding=0)
 
+        self.program_label = gtk.Label("Program settings")
+        self.program_label.show()
+        self.right_vbox.pack_start(self.program_label, expand=False, fill=False, padding=0)
+        settings_lst = state.settings.get_settings_list()
+        if settings_lst != None:
+            debug("  "+str(settings_lst))
+            for s in settings_lst:
+                dct = {}
+                if s.type == "float":
+                    w = self.__mk_labeled_spin(dct, s.display_name, s, None, s.default, s.min, s.max)
+                    self.right_vbox.pack_start(w, expand=False, fill=False, padding=0)
+                elif s.type == "enum":
+                    w = self.__mk_labeled_combo(dct, s.display_name, s, s.options, s.default)
+                    self.right_vbox.pack_start(w, expand=False, fill=False, padding=0)
+
         self.settings_vb = gtk.VBox(homogeneous=False, spacing=0)
         self.settings_vb.show()
         self.right_vbox.pack_start(self.settings_vb, expand=False, fill=False, padding=0)
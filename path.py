@@ -1,5 +1,5 @@
 from elements import *
-from calc_utils import pt_to_pt_dist
+from calc_utils import pt_to_pt_dist, linearized_path_aabb, OverlapEnum, linearized_path_to_arrays, pts_in_path_winding
 from tool_operation import TOEnum
 
 from logging import debug, info, warning, error, critical
@@ -7,11 +7,60 @@ from util import dbgfname
 
 
 import json
+import math
+
+# Endpoints of the elements hashed by cells of the join tolerance size. Any
+# endpoint closer than the tolerance to a query point lies in one of the 3x3
+# cells around it, so a lookup touches only those candidates.
+class EndpointIndex(object):
+    def __init__(self, elements, tolerance=0.001):
+        self.tolerance = tolerance
+        self.cells = {}
+        self.keys = {}
+        self.elements = {}
+        self.first_alive = 0
+        for i, e in enumerate(elements):
+            self.elements[i] = e
+            self.keys[i] = set([self.__cell(e.start), self.__cell(e.end)])
+            for k in self.keys[i]:
+                self.cells.setdefault(k, []).append(i)
+        self.total = len(elements)
+
+    def __cell(self, pt):
+        return (int(math.floor(pt[0]/self.tolerance)), int(math.floor(pt[1]/self.tolerance)))
+
+    def __len__(self):
+        return len(self.elements)
+
+    def get_first(self):
+        while self.first_alive<self.total and not (self.first_alive in self.elements):
+            self.first_alive += 1
+        return self.first_alive
+
+    def remove(self, i):
+        for k in self.keys[i]:
+            self.cells[k].remove(i)
+            if len(self.cells[k]) == 0:
+                del self.cells[k]
+        del self.keys[i]
+        del self.elements[i]
+
+    # ids of alive elements with an endpoint near pt, in the original order
+    def get_candidates(self, pt):
+        cx, cy = self.__cell(pt)
+        ids = set()
+        for dx in [-1, 0, 1]:
+            for dy in [-1, 0, 1]:
+                k = (cx+dx, cy+dy)
+                if k in self.cells:
+                    ids.update(self.cells[k])
+        return sorted(ids)
 
 class Path(Element):
     def __init__(self, state, elements=None, name=None, lt_name=None, data=None):
 
         self.state = state
+        self.closed = False
         if data == None:
             self.display = True
             self.elements = elements
@@ -35,6 +84,7 @@ class Path(Element):
                 'display': self.display, 
                 'elements': elements,
                 'ordered_elements': ordered_elements,
+                'closed': self.closed,
                 'lt_name': self.lt.name}
 
     def deserialize(self, data):
@@ -66,16 +116,34 @@ class Path(Element):
             if e["type"] == "epoint":
                 self.ordered_elements.append(EPoint(lt=lt, data=e))
 
+        # projects saved before the flag was kept get it from the chain
+        if "closed" in data:
+            self.closed = data["closed"]
+        else:
+            oe = self.ordered_elements
+            self.closed = len(oe) > 0 and type(oe[0]).__name__ != "EPoint" and self.__is_chain_closed(oe)
+
 
     def add_element(self, e):
         self.elements.append(e)
 
-    def __find_adjacent_element(self, current, available, direction_fwd=True):
-        min_dist = pt_to_pt_dist(available[0].start, current.end)
-        min_dist_id = 0
+    # same search as a scan over all available elements in their original
+    # order (first minimal distance wins), but only endpoint index
+    # candidates are visited
+    def __find_adjacent_element(self, current, index, direction_fwd=True):
+        first = index.get_first()
+        min_dist = pt_to_pt_dist(index.elements[first].start, current.end)
+        min_dist_id = first
         min_order = {"turnaround": False, "offset": 1}
+        if direction_fwd:
+            candidates = index.get_candidates(current.end)
+        else:
+            candidates = index.get_candidates(current.start)
+        if min_dist < index.tolerance and not (first in candidates):
+            candidates.insert(0, first)
         #print "current:", current
-        for i, e in enumerate(available):
+        for i in candidates:
+            e = index.elements[i]
             orders = []
             dists = []
             if direction_fwd:
@@ -97,93 +165,139 @@ class Path(Element):
                 #print "md, i:", md, i
         return min_dist, min_dist_id, min_order
 
-    def __append_element(self, min_dist_id, min_order, available, ordered_elements, ce):
+    def __append_element(self, min_dist_id, min_order, index, ordered_elements, ce):
         i = min_dist_id
-        ce.append(available[i])
+        e = index.elements[i]
+        index.remove(i)
+        ce.append(e)
         if min_order["offset"] == 1:
             if min_order["turnaround"] == False:
-                available[i].start = ordered_elements[-1].end
-                ordered_elements.append(available[i])
+                e.start = ordered_elements[-1].end
+                ordered_elements.append(e)
             else:
-                available[i].end = ordered_elements[-1].end
-                ordered_elements.append(available[i].turnaround())
+                e.end = ordered_elements[-1].end
+                ordered_elements.append(e.turnaround())
         else:
             if min_order["turnaround"] == False:
-                available[i].end = ordered_elements[0].start
-                ordered_elements.insert(0, available[i])
+                e.end = ordered_elements[0].start
+                ordered_elements.insert(0, e)
             else:
-                available[i].start = ordered_elements[0].start
-                ordered_elements.insert(0, available[i].turnaround())
-        del available[i]
-
-
-    def mk_connected_path(self):
-        dbgfname()
-        if len(self.elements)==0:
-            return None
-
-        if not self.elements[0].joinable:
-            p = Path(self.state, [self.elements[0]], self.name+".path", self.state.settings.get_def_lt())
-            p.ordered_elements = [self.elements[0]]
-            return p
-        available = self.elements[:]
-        ce = [] # connected elements go here
-
-        not_joinables = []
-        for i, e in enumerate(available):
-            if not e.joinable:
-                not_joinables.append(i)
-
-        not_joinables.reverse()
-        for nj in not_joinables:
-            del available[nj]
-
-        available_len = len(available)
+                e.start = ordered_elements[0].start
+                ordered_elements.insert(0, e.turnaround())
 
-        if available_len==0:
-            return None
 
-        #find first joinable
-        self.order = [0]
-        ce.append(available[0])
-        ordered_elements = [available[0]]
-        del available[0]
+    # grows the chain from seed in both directions while the endpoint index
+    # has an element within the 0.001 join tolerance of either chain end
+    def __grow_chain(self, seed, index):
+        ce = [seed] # connected elements go here
+        ordered_elements = [seed]
 
         while True:
-            if len(available)==0:
+            if len(index)==0:
                 break
             cont = False
             current = (ordered_elements[-1], ordered_elements[0])
             #print "ordered_elements:", ordered_elements
             #print "current:", current
-            #print "available:", available
-            min_dist, min_dist_id, min_order = self.__find_adjacent_element(current[0], available)
+            min_dist, min_dist_id, min_order = self.__find_adjacent_element(current[0], index)
             #print "md, mdi, mo:", min_dist, min_dist_id, min_order
             if (min_dist<0.001):
                 
-                self.__append_element(min_dist_id, min_order, available, ordered_elements, ce)
+                self.__append_element(min_dist_id, min_order, index, ordered_elements, ce)
                 #print "append, turnaround:", min_order["turnaround"]
                 cont = True
             if not cont:
-                min_dist, min_dist_id, min_order = self.__find_adjacent_element(current[1], available, False)
+                min_dist, min_dist_id, min_order = self.__find_adjacent_element(current[1], index, False)
                 if (min_dist<0.001):
-                    self.__append_element(min_dist_id, min_order, available, ordered_elements, ce)
+                    self.__append_element(min_dist_id, min_order, index, ordered_elements, ce)
                     #print "prepend, turnaround:", min_order["turnaround"]
                     cont = True
 
             if not cont:
                 debug("  I`ve tried hard, but still no success, so break")
                 break
+        return ce, ordered_elements
+
+    def __is_chain_closed(self, ordered_elements):
+        s = ordered_elements[0].start
+        e = ordered_elements[-1].end
+        return abs(s[0]-e[0])<0.001 and abs(s[1]-e[1])<0.001
+
+    # Elements are looked up through an EndpointIndex keyed by the 0.001 join
+    # tolerance cell, so joining n elements costs O(n) lookups of the nearby
+    # candidates instead of O(n^2) distance checks.
+    def mk_connected_path(self):
+        dbgfname()
+        if len(self.elements)==0:
+            return None
+
+        if not self.elements[0].joinable:
+            p = Path(self.state, [self.elements[0]], self.name+".path", self.state.settings.get_def_lt())
+            p.ordered_elements = [self.elements[0]]
+            return p
+        available = []
+        for e in self.elements:
+            if e.joinable:
+                available.append(e)
+
+        available_len = len(available)
+
+        if available_len==0:
+            return None
+
+        #find first joinable
+        self.order = [0]
+        index = EndpointIndex(available[1:], 0.001)
+        ce, ordered_elements = self.__grow_chain(available[0], index)
 
-        if abs(ce[0].start[0]-ce[-1].end[0])<0.001 and abs(ce[0].start[1]-ce[-1].end[1])<0.001:
-            pass # have to move joined path to separate subpath
         debug("  available len", available_len, "len(ce):"+str(len(ce)))
-        debug("  "+str(available))
+        debug("  "+str(index.elements.values()))
         #if available_len == len(ce):
         p = Path(self.state, ce, self.name+".sub", self.state.settings.get_def_lt().name)
         p.ordered_elements = ordered_elements
+        if self.__is_chain_closed(ordered_elements):
+            p.set_closed()
         return p
 
+    # Splits all elements into connected chains in one pass: every chain is
+    # seeded with the first element not used yet and grown like in
+    # mk_connected_path, the shared endpoint index keeps the whole split
+    # near linear. Elements which can't be joined (circles, points) become
+    # single element paths. Returns a list of paths, closed chains are
+    # marked with set_closed().
+    def mk_connected_paths(self):
+        dbgfname()
+        paths = []
+        single = []
+        available = []
+        for e in self.elements:
+            if e.joinable:
+                available.append(e)
+            else:
+                single.append(e)
+
+        index = EndpointIndex(available, 0.001)
+        while len(index)>0:
+            first = index.get_first()
+            seed = index.elements[first]
+            index.remove(first)
+            ce, ordered_elements = self.__grow_chain(seed, index)
+            p = Path(self.state, ce, self.name+".sub", self.state.settings.get_def_lt().name)
+            p.ordered_elements = ordered_elements
+            if self.__is_chain_closed(ordered_elements):
+                p.set_closed()
+            paths.append(p)
+
+        for e in single:
+            p = Path(self.state, [e], self.name+".path", self.state.settings.get_def_lt().name)
+            p.ordered_elements = [e]
+            if type(e).__name__ == "ECircle":
+                p.set_closed()
+            paths.append(p)
+
+        debug("  chains: "+str(len(paths))+" closed: "+str(len([p for p in paths if p.get_closed()])))
+        return paths
+
     def set_closed(self):
         self.closed = True
 
@@ -201,3 +315,72 @@ class Path(Element):
 
     def __repr__(self):
         return "<Path "+str(self.elements)+">"
+
+
+class ContourNode(object):
+    def __init__(self, path, lpath, aabb):
+        self.path = path
+        self.lpath = lpath
+        self.aabb = aabb
+        self.parent = None
+        self.children = []
+        self.depth = 0
+
+    # odd depth contours lie inside of material boundary, so they are holes
+    # for pocketing and islands for the contour they are nested in
+    def is_hole(self):
+        return (self.depth % 2) == 1
+
+    def __repr__(self):
+        return "<ContourNode "+str(self.path.name)+" depth: "+str(self.depth)+" children: "+str(len(self.children))+">"
+
+# Builds containment hierarchy of closed paths. Contours are sorted by AABB
+# area, so every parent candidate of a contour is checked before it, a
+# candidate pair is only tested with a point-in-path test (one vectorized
+# call per parent) when AABBs of the pair are nested. The parent is the
+# smallest contour containing the first point of the child. Open paths are
+# skipped, they can't contain anything. Returns roots of the containment
+# forest.
+def mk_containment_tree(paths):
+    dbgfname()
+    nodes = []
+    for p in paths:
+        if not p.get_closed():
+            continue
+        lpath = []
+        for e in p.get_ordered_elements():
+            if type(e).__name__ == "EArc" or type(e).__name__ == "ECircle":
+                lpath += e.linearize(0.01)
+            elif type(e).__name__ == "ELine":
+                lpath.append(e)
+        if len(lpath) == 0:
+            continue
+        nodes.append(ContourNode(p, lpath, linearized_path_aabb(lpath)))
+
+    area = lambda n: (n.aabb.right-n.aabb.left)*(n.aabb.top-n.aabb.bottom)
+    nodes.sort(key=area, reverse=True)
+
+    arrays = {}
+    for i, n in enumerate(nodes):
+        pt = n.lpath[0].start
+        # candidates are visited from the smallest one, first hit is the parent
+        for j in range(i-1, -1, -1):
+            c = nodes[j]
+            if c.aabb.aabb_in_aabb(n.aabb) != OverlapEnum.fully_covers:
+                continue
+            if not (j in arrays):
+                arrays[j] = linearized_path_to_arrays(c.lpath)
+            starts, ends = arrays[j]
+            if pts_in_path_winding([pt], starts, ends)[0]:
+                n.parent = c
+                c.children.append(n)
+                break
+
+    roots = []
+    for n in nodes:
+        if n.parent == None:
+            roots.append(n)
+        else:
+            n.depth = n.parent.depth+1
+    debug("  contours: "+str(len(nodes))+" roots: "+str(len(roots)))
+    return roots
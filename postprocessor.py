@@ -55,6 +55,41 @@ class Postprocessor:
         debug("  set_absolute is not implemented")
         return None        
 
+    def mk_drill_cycle(self, pt, r, peck=None):
+        dbgfname()
+        debug("  mk_drill_cycle is not implemented")
+        return None
+
+    def compile_move(self, pt):
+        dbgfname()
+        debug("  compile_move is not implemented")
+        return None
+
+    def compile_cw_arc(self, r, end):
+        dbgfname()
+        debug("  compile_cw_arc is not implemented")
+        return None
+
+    def compile_ccw_arc(self, r, end):
+        dbgfname()
+        debug("  compile_ccw_arc is not implemented")
+        return None
+
+    def compile_cw_ijk_arc(self, center, end):
+        dbgfname()
+        debug("  compile_cw_ijk_arc is not implemented")
+        return None
+
+    def compile_ccw_ijk_arc(self, center, end):
+        dbgfname()
+        debug("  compile_ccw_ijk_arc is not implemented")
+        return None
+
+    def emit_compiled(self, records, z):
+        dbgfname()
+        debug("  emit_compiled is not implemented")
+        return []
+
     def move_to_rapid(self):
         dbgfname()
         debug("  move_to_rapid is not implemented")
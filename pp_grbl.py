@@ -1,20 +1,63 @@
 from postprocessor import Postprocessor
 
+# In compact mode the modal state (motion mode, last X/Y/Z and feed) is
+# tracked and only words that changed are written, numbers without
+# trailing zeros. Arcs always carry their plane axes, GRBL rejects arcs
+# without them. GRBL has no canned cycles, canned_cycles enables G81/G83
+# output for controllers that have them.
 class PPGRBL:
-    def __init__(self):
-        pass
+    def __init__(self, compact=False, canned_cycles=False):
+        self.compact = compact
+        self.canned_cycles = canned_cycles
+        self.reset()
 
-    def move_to(self, pt):
-        out = "G01 X%.3fY%.3fZ%.3f\r\n" % (pt[0], pt[1], pt[2])
+    # forgets the modal state, so the next move writes all of its words
+    def reset(self):
+        self.motion = None
+        self.position = [None, None, None]
+        self.feedrate = None
+        self.cycle_words = None
+
+    def __fmt(self, v):
+        out = "%.3f" % v
+        if self.compact:
+            out = out.rstrip("0").rstrip(".")
+            if out == "-0":
+                out = "0"
         return out
 
+    def __move(self, motion, pt, tail="", plane_axes=False):
+        return self.__move_fmt(motion, [self.__fmt(v) for v in pt[:3]], tail, plane_axes)
+
+    def __move_fmt(self, motion, fpt, tail, plane_axes):
+        words = ""
+        for i, axis in enumerate("XYZ"):
+            v = fpt[i]
+            if (not self.compact) or v != self.position[i] or (plane_axes and i<2):
+                words += axis+v
+            self.position[i] = v
+        if words == "" and tail == "":
+            return ""
+        if (not self.compact) or motion != self.motion:
+            words = motion+" "+words
+        self.motion = motion
+        return words+tail+"\r\n"
+
+    def move_to(self, pt):
+        return self.__move("G01", pt)
+
     def move_to_rapid(self, pt):
-        out = "G00 X%.3fY%.3fZ%.3f\r\n" % (pt[0], pt[1], pt[2])
-        return out
+        return self.__move("G00", pt)
 
     def set_feedrate(self, fr):
-        out = "G94\r\n"
-        out+= "F%.3f\r\n" % fr
+        v = self.__fmt(fr)
+        if self.compact and v == self.feedrate:
+            return ""
+        out = ""
+        if (not self.compact) or self.feedrate == None:
+            out += "G94\r\n"
+        out+= "F%s\r\n" % v
+        self.feedrate = v
         return out
 
     def set_metric(self):
@@ -24,17 +67,59 @@ class PPGRBL:
         return "G90\r\n"
 
     def mk_cw_arc(self, r, end):
-        out = "G02 X%.3fY%.3fZ%.3f R%.3f\r\n" % (end[0], end[1], end[2], r)
-        return out
+        return self.__move("G02", end, " R"+self.__fmt(r), True)
 
     def mk_ccw_arc(self, r, end):
-        out = "G03 X%.3fY%.3fZ%.3f R%.3f\r\n" % (end[0], end[1], end[2], r)
-        return out
+        return self.__move("G03", end, " R"+self.__fmt(r), True)
 
     def mk_cw_ijk_arc(self, center, end):
-        out = "G02 X%.3fY%.3fZ%.3f I%.3fJ%.3fK%.3f\r\n" % (end[0], end[1], end[2], center[0], center[1], center[2])
-        return out
+        return self.__move("G02", end, " I%sJ%sK%s" % (self.__fmt(center[0]), self.__fmt(center[1]), self.__fmt(center[2])), True)
 
     def mk_ccw_ijk_arc(self, center, end):
-        out = "G03 X%.3fY%.3fZ%.3f I%.3fJ%.3fK%.3f\r\n" % (end[0], end[1], end[2], center[0], center[1], center[2])
-        return out
+        return self.__move("G03", end, " I%sJ%sK%s" % (self.__fmt(center[0]), self.__fmt(center[1]), self.__fmt(center[2])), True)
+
+    # Compiled moves: the motion word, formatted X and Y and the arc words of
+    # a move are prepared once, emit_compiled writes them for one depth pass
+    # formatting only the Z word. Same output as the calls above.
+    def compile_move(self, pt):
+        return ("G01", self.__fmt(pt[0]), self.__fmt(pt[1]), "", False)
+
+    def compile_cw_arc(self, r, end):
+        return ("G02", self.__fmt(end[0]), self.__fmt(end[1]), " R"+self.__fmt(r), True)
+
+    def compile_ccw_arc(self, r, end):
+        return ("G03", self.__fmt(end[0]), self.__fmt(end[1]), " R"+self.__fmt(r), True)
+
+    def compile_cw_ijk_arc(self, center, end):
+        return ("G02", self.__fmt(end[0]), self.__fmt(end[1]), " I%sJ%sK%s" % (self.__fmt(center[0]), self.__fmt(center[1]), self.__fmt(center[2])), True)
+
+    def compile_ccw_ijk_arc(self, center, end):
+        return ("G03", self.__fmt(end[0]), self.__fmt(end[1]), " I%sJ%sK%s" % (self.__fmt(center[0]), self.__fmt(center[1]), self.__fmt(center[2])), True)
+
+    def emit_compiled(self, records, z):
+        fz = self.__fmt(z)
+        for motion, fx, fy, tail, plane_axes in records:
+            yield self.__move_fmt(motion, (fx, fy, fz), tail, plane_axes)
+
+    # canned drilling cycle at pt (x, y, bottom z) retracting to r, in
+    # pecks of peck mm (G83) or in one feed (G81), None when canned cycles
+    # are not available
+    def mk_drill_cycle(self, pt, r, peck=None):
+        if not self.canned_cycles:
+            return None
+        motion = "G81" if peck == None else "G83"
+        cycle_words = "Z"+self.__fmt(pt[2])+"R"+self.__fmt(r)
+        if peck != None:
+            cycle_words += "Q"+self.__fmt(peck)
+        words = "X"+self.__fmt(pt[0])+"Y"+self.__fmt(pt[1])
+        if (not self.compact) or motion != self.motion or cycle_words != self.cycle_words:
+            words = "G99 "+motion+" "+words+cycle_words
+        self.motion = motion
+        self.cycle_words = cycle_words
+        self.position = [self.__fmt(pt[0]), self.__fmt(pt[1]), self.__fmt(r)]
+        return words+"\r\n"
+
+    def cancel_drill_cycle(self):
+        self.motion = None
+        self.cycle_words = None
+        return "G80\r\n"
@@ -5,68 +5,435 @@ import os
 
 from logging import debug, info, warning, error, critical
 from util import dbgfname
+from commands import COMMAND_COST, ELEMENT_COST
 
 import json
+import hashlib
+import threading
 from copy import deepcopy
 
+# every CHECKPOINT_INTERVAL-th step keeps the full serialized state, so
+# rebuilding a step applies at most that many deltas
+CHECKPOINT_INTERVAL = 32
+
+# Paths in steps are content hashes into the project path pool, every
+# version of a path's geometry is kept once however many steps use it.
+def path_hash(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
+
+# Difference between two serialized states. View fields and settings are
+# kept only when they changed, paths are the list of path hashes. Tool
+# operations are a list where an int is the index of an unchanged entry of
+# the previous state and a dict is new data. Journals written before paths
+# were pooled also have int and dict entries in paths.
+def state_delta(prev, cur):
+    delta = {}
+    for k in ["screen_offset", "base_offset", "scale", "settings"]:
+        if cur[k] != prev[k]:
+            delta[k] = cur[k]
+
+    delta["paths"] = list(cur["paths"])
+
+    prev_ops = prev["tool_operations"]
+    delta["tool_operations"] = []
+    for i, op in enumerate(cur["tool_operations"]):
+        if i < len(prev_ops) and (prev_ops[i] is op or prev_ops[i] == op):
+            delta["tool_operations"].append(i)
+        else:
+            delta["tool_operations"].append(op)
+    return delta
+
+# rebuilds the serialized state from the previous one, unchanged entries
+# are shared with it
+def apply_state_delta(prev, delta):
+    cur = dict(prev)
+    for k in ["screen_offset", "base_offset", "scale", "settings"]:
+        if k in delta:
+            cur[k] = delta[k]
+    cur["paths"] = [prev["paths"][p] if type(p) == int else p for p in delta["paths"]]
+    cur["tool_operations"] = [prev["tool_operations"][op] if type(op) == int else op for op in delta["tool_operations"]]
+    return cur
+
+# Rough memory estimate of a pooled path for the history budget, records
+# not parsed yet cost their text
+def pooled_path_size(entry):
+    if isinstance(entry, dict):
+        return COMMAND_COST+(len(entry["elements"])+len(entry["ordered_elements"]))*ELEMENT_COST
+    return len(entry)
+
+# Steps loaded from a journal keep the record text and parse it on first
+# use, only the steps needed to rebuild a state are ever parsed.
 class Step(object):
-    def __init__(self, state=None, data=None):
+    def __init__(self, full=None, delta=None, data=None, raw=None):
+        self.raw = raw
+        # length of the record text, the memory estimate of the step
+        self.size = 0
+        if raw != None:
+            self.size = len(raw)
         if data == None:
-            self.state=state
+            self.full = full
+            self.delta = delta
         else:
             self.deserialize(data)
-        self.serialized_state = self.state.serialize()
+
+    def __parse(self):
+        if self.raw != None:
+            self.deserialize(json.loads(self.raw))
+            self.raw = None
+
+    def is_checkpoint(self):
+        if self.raw != None:
+            return self.raw.startswith('{"state"')
+        return self.full != None
+
+    def get_full(self):
+        self.__parse()
+        return self.full
+
+    def get_delta(self):
+        self.__parse()
+        return self.delta
 
     def serialize(self):
-        return {'state': self.serialized_state}
+        if self.is_checkpoint():
+            return {'state': self.get_full()}
+        return {'delta': self.get_delta()}
+
+    # record text for the journal, raw records are written back unparsed
+    def serialize_json(self):
+        if self.raw != None:
+            return self.raw
+        return json.dumps(self.serialize())
 
     def deserialize(self, data):
-        self.state = State(data["state"])
+        self.full = data.get("state")
+        self.delta = data.get("delta")
 
     def __repr__(self):
-        return str(self.state)
+        if self.is_checkpoint():
+            return "<Step checkpoint>"
+        return "<Step delta>"
+
+
+# Append-only project file (format 2): a header line, then one json record
+# per step as Step.serialize() gives it and one per pooled path, written
+# before the first step using it. Records are flushed as they are
+# appended and fsync'd by a background thread, so a crash loses at most
+# the step being written.
+class Journal(object):
+    def __init__(self, path, mode="a"):
+        self.path = path
+        self.f = open(path, mode)
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        self.thread = threading.Thread(target=self.__sync_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # the fd is duplicated under the lock and synced outside it, so appends
+    # don't wait for the disk
+    def __sync_loop(self):
+        while True:
+            self.pending.wait()
+            self.pending.clear()
+            with self.lock:
+                if self.f.closed:
+                    return
+                fd = os.dup(self.f.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def write_header(self):
+        self.append(json.dumps({'format_version': 2}))
 
+    # the hash leads the record, so loading finds it without parsing
+    def append_path(self, h, data):
+        self.append('{"path": "'+h+'", "data": '+json.dumps(data)+'}')
+
+    def append(self, line):
+        with self.lock:
+            self.f.write(line+"\n")
+            self.f.flush()
+        self.pending.set()
+
+    # everything appended so far is on disk when it returns
+    def sync(self):
+        with self.lock:
+            self.f.flush()
+            fd = os.dup(self.f.fileno())
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        with self.lock:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.f.close()
+        self.pending.set()
 
 class Project(object):
     def __init__(self):
         self.steps = []
+        # serialized state of the last step
+        self.last = None
+        # path name -> (key, references keeping key ids alive, path hash)
+        self.path_cache = {}
+        # path hash -> serialized path, or its journal record not parsed yet
+        self.path_pool = {}
+        # journal of the saved project, steps are appended to it as pushed
+        self.journal = None
+        # bytes the steps and the pool may take, None for no limit
+        self.budget = None
+        self.used = 0
+
+    # forgets the history and detaches from the project file
+    def reset(self):
+        if self.journal != None:
+            self.journal.close()
+            self.journal = None
+        self.steps = []
+        self.last = None
+        self.path_cache = {}
+        self.path_pool = {}
+        self.used = 0
+
+    # Paths are changed by replacing their elements, never by editing
+    # elements in place, so element identities tell whether the cached
+    # serialization is still valid.
+    def __path_key(self, p):
+        return (id(p), p.display, p.lt.name, tuple([id(e) for e in p.elements]), tuple([id(e) for e in p.ordered_elements]))
+
+    def __cache_path(self, p, data):
+        return (self.__path_key(p), (p, list(p.elements), list(p.ordered_elements)), data)
+
+    def __pool_path(self, data):
+        h = path_hash(data)
+        if not h in self.path_pool:
+            self.path_pool[h] = data
+            self.used += pooled_path_size(data)
+            if self.journal != None:
+                self.journal.append_path(h, data)
+        return h
+
+    def __get_pooled_path(self, entry):
+        if isinstance(entry, dict):
+            return entry
+        data = self.path_pool[entry]
+        if not isinstance(data, dict):
+            data = json.loads(data)["data"]
+            self.path_pool[entry] = data
+        return data
+
+    def __serialize_state(self, state):
+        cache = {}
+        paths = []
+        for p in state.paths:
+            c = self.path_cache.get(p.name)
+            if c == None or c[0] != self.__path_key(p):
+                c = self.__cache_path(p, self.__pool_path(p.serialize()))
+            cache[p.name] = c
+            paths.append(c[2])
+        self.path_cache = cache
+
+        data = state.serialize_view()
+        data["settings"] = state.settings.serialize()
+        data["paths"] = paths
+        data["tool_operations"] = [to.serialize() for to in state.tool_operations]
+        return data
+
+    def __append(self, data):
+        if self.last == None or len(self.steps) % CHECKPOINT_INTERVAL == 0:
+            self.steps.append(Step(full=data))
+        else:
+            self.steps.append(Step(delta=state_delta(self.last, data)))
+        # keep sharing unchanged entries with the previous step
+        if not self.steps[-1].is_checkpoint():
+            data = apply_state_delta(self.last, self.steps[-1].get_delta())
+        self.last = data
+        line = self.steps[-1].serialize_json()
+        self.steps[-1].size = len(line)
+        self.used += len(line)
+        if self.journal != None:
+            self.journal.append(line)
+        self.__trim()
+
+    def __measure(self):
+        self.used = sum([st.size for st in self.steps])+sum([pooled_path_size(e) for e in self.path_pool.values()])
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self.__trim()
+
+    # Over the budget the older half of the steps is dropped until the rest
+    # fits, the journal is compacted to the steps kept. Undo and redo push
+    # steps too, so they are bounded the same way.
+    def __trim(self):
+        dbgfname()
+        if self.budget == None or self.used <= self.budget or len(self.steps) < 2:
+            return
+        keep = len(self.steps)
+        while keep > 1:
+            keep = keep//2
+            self.__keep_last(keep)
+            if self.used <= self.budget:
+                break
+        if self.journal != None:
+            self.compact()
+        debug("  history trimmed to "+str(len(self.steps))+" steps, used: "+str(self.used))
+
+    # state of step i as kept in steps, rebuilt from the closest checkpoint
+    def __get_step_state(self, i):
+        if i < 0:
+            i += len(self.steps)
+        start = i
+        while not self.steps[start].is_checkpoint():
+            start -= 1
+        data = self.steps[start].get_full()
+        for s in self.steps[start+1:i+1]:
+            data = apply_state_delta(data, s.get_delta())
+        return data
+
+    # serialized state of step i with the paths taken from the pool
+    def get_serialized_state(self, i):
+        data = dict(self.__get_step_state(i))
+        data["paths"] = [self.__get_pooled_path(p) for p in data["paths"]]
+        return data
+
+    def get_state(self, i):
+        return State(self.get_serialized_state(i))
 
     def load(self, project_path):
         dbgfname()
         from events import ep, ee
         #global state
         debug("  loading project from "+str(project_path))
+        self.reset()
         f = open(project_path)
-        data = f.read()
-        f.close()
-        parsed_json = json.loads(data)
-        #print "json:", parsed_json
-        if parsed_json["format_version"] == 1:
-            for s in parsed_json["steps"]:
-                self.steps.append(Step(data=s))
-
-            debug("  steps: "+str(len(self.steps)))
-            state.state.set(self.steps[-1].state)
-            ep.push_event(ee.update_tool_operations_list, (None))
-            ep.push_event(ee.update_paths_list, (None))
-            ep.mw.widget.update()
+        header = json.loads(f.readline())
+        if header["format_version"] == 1:
+            # the whole format 1 file is one json line
+            f.close()
+            for s in header["steps"]:
+                data = s["state"]
+                data["paths"] = [self.__pool_path(p) for p in data["paths"]]
+                self.__append(data)
+        elif header["format_version"] == 2:
+            complete = True
+            for line in f:
+                if not line.endswith("\n"):
+                    # record cut by a crash, drop it
+                    complete = False
+                    break
+                if line.startswith('{"path": "'):
+                    self.path_pool[line[10:50]] = line[:-1]
+                else:
+                    self.steps.append(Step(raw=line[:-1]))
+            f.close()
+            if len(self.steps) == 0:
+                debug("  Can't load, no steps")
+                return
+            self.last = self.__get_step_state(-1)
+            self.__measure()
+            if complete:
+                self.journal = Journal(project_path)
+            else:
+                self.compact(project_path, len(self.steps))
         else:
+            f.close()
             debug("  Can't load, unsupported format")
+            return
+
+        debug("  steps: "+str(len(self.steps)))
+        paths = [self.__get_pooled_path(p) for p in self.last["paths"]]
+        loaded = State(dict(self.last, paths=paths))
+        self.path_cache = {}
+        for p, d, entry in zip(loaded.paths, paths, self.last["paths"]):
+            if isinstance(entry, dict):
+                entry = self.__pool_path(d)
+            self.path_cache[p.name] = self.__cache_path(p, entry)
+        state.state.set(loaded)
+        ep.push_event(ee.update_tool_operations_list, (None))
+        ep.push_event(ee.update_paths_list, (None))
+        ep.mw.widget.update()
 
+    # only paths whose elements changed since the previous step are
+    # serialized again, the step keeps the difference to the previous one
     def push_state(self, state):
         dbgfname()
-        self.steps.append(Step(state))
+        self.__append(self.__serialize_state(state))
         debug("  steps length:"+str(len(self.steps)))
 
+    # Steps are already in the journal when saving to the same file, so it
+    # is only synced. Other files get the history compacted into them and
+    # become the journal.
     def save(self, project_path):
         if os.path.splitext(project_path)[1][1:].strip() != "bcam":
             project_path+=".bcam"
 
-        # format 1
-        serialized_steps = [s.serialize() for s in self.steps]
-        f = open(project_path, 'w')
-        f.write(json.dumps({'format_version': 1, 'steps': serialized_steps}))
-        f.close()
+        if self.journal != None and os.path.abspath(self.journal.path) == os.path.abspath(project_path):
+            self.journal.sync()
+            return True
+        self.compact(project_path)
+        return True
+
+    # drops all but the last keep steps, the first of them becoming a
+    # checkpoint
+    def __keep_last(self, keep):
+        if len(self.steps) > keep:
+            first = len(self.steps)-keep
+            self.steps = [Step(full=self.__get_step_state(first))]+self.steps[first+1:]
+            self.steps[0].size = len(self.steps[0].serialize_json())
+        self.__prune_pool()
+
+    # drops pooled paths no step uses
+    def __prune_pool(self):
+        if len(self.steps) == 0:
+            self.path_pool = {}
+            self.used = 0
+            return
+        used = set()
+        for st in self.steps:
+            if st.is_checkpoint():
+                entries = st.get_full()["paths"]
+            else:
+                entries = st.get_delta()["paths"]
+            used.update([p for p in entries if not isinstance(p, int) and not isinstance(p, dict)])
+        self.path_pool = dict([(h, self.path_pool[h]) for h in used])
+        self.__measure()
+
+    # Rewrites the journal with only the last keep steps (all when None),
+    # the first of them becoming a checkpoint, and the pooled paths they
+    # use. The file is replaced atomically, a crash leaves the old one.
+    def compact(self, project_path=None, keep=None):
+        dbgfname()
+        if project_path == None:
+            if self.journal == None:
+                return False
+            project_path = self.journal.path
+        if keep != None:
+            self.__keep_last(keep)
+        else:
+            self.__prune_pool()
+        if self.journal != None:
+            self.journal.close()
+        tmp_path = project_path+".tmp"
+        journal = Journal(tmp_path, "w")
+        journal.write_header()
+        for h, data in self.path_pool.items():
+            if isinstance(data, dict):
+                journal.append_path(h, data)
+            else:
+                journal.append(data)
+        for s in self.steps:
+            journal.append(s.serialize_json())
+        journal.close()
+        os.rename(tmp_path, project_path)
+        self.journal = Journal(project_path)
+        debug("  compacted "+str(len(self.steps))+" steps to "+project_path)
         return True
 
 project = Project()
@@ -1,6 +1,7 @@
 from tool import Tool, ToolType
 from generalized_setting import TOSetting
 from pp_grbl import PPGRBL
+from tool_operation import OrderEnum, DrillCyclesEnum, GcodeOutputEnum
 
 class LineType:
     def __init__(self, lw=None, selected_lw=None, color=None, selected_color=None, name=None, data=None):
@@ -69,12 +70,16 @@ class Settings:
             self.line_types = {"default": LineType(0.5, 0.7, (0,0,0), (1,0,0), "default")}
             self.tool = Tool("cylinder", ToolType.cylinder)
             self.material = Material()
+            self.op_order = OrderEnum.listed
+            self.drill_cycles = DrillCyclesEnum.expanded
+            self.gcode_output = GcodeOutputEnum.compact
+            self.undo_budget = 64
         else:
             self.deserialize(data)
 
 
         self.select_box_lt = LineType(1.0, 1.0, (0, 1, 0, 0.2), (0, 1, 0, 0.2), "select box lt")
-        self.default_pp = PPGRBL()
+        self.default_pp = PPGRBL(compact=(self.gcode_output == GcodeOutputEnum.compact), canned_cycles=(self.drill_cycles == DrillCyclesEnum.canned))
 
     def get_material(self):
         return self.material      
@@ -82,6 +87,27 @@ class Settings:
     def get_tool(self):
         return self.tool
 
+    def get_settings_list(self):
+        settings_lst = [TOSetting("enum", None, None, self.op_order, "Operations order: ", self.set_op_order_s, OrderEnum.options),
+                        TOSetting("enum", None, None, self.drill_cycles, "Drilling: ", self.set_drill_cycles_s, DrillCyclesEnum.options),
+                        TOSetting("enum", None, None, self.gcode_output, "G-code output: ", self.set_gcode_output_s, GcodeOutputEnum.options),
+                        TOSetting("float", 1, 4096, self.undo_budget, "Undo memory, MB: ", self.set_undo_budget_s)]
+        return settings_lst
+
+    def set_op_order_s(self, setting):
+        self.op_order = setting.new_value
+
+    def set_drill_cycles_s(self, setting):
+        self.drill_cycles = setting.new_value
+        self.default_pp.canned_cycles = (self.drill_cycles == DrillCyclesEnum.canned)
+
+    def set_gcode_output_s(self, setting):
+        self.gcode_output = setting.new_value
+        self.default_pp.compact = (self.gcode_output == GcodeOutputEnum.compact)
+
+    def set_undo_budget_s(self, setting):
+        self.undo_budget = setting.new_value
+
     def get_lt(self, name):
         if name in self.line_types:
             return self.line_types[name]
@@ -91,7 +117,7 @@ class Settings:
         return self.line_types["default"]
 
     def serialize(self):
-        return {"type": "settings", "material": self.material.serialize(), "linetypes": [l.serialize() for k, l in self.line_types.iteritems()], "tool": self.tool.serialize()}
+        return {"type": "settings", "material": self.material.serialize(), "linetypes": [l.serialize() for k, l in self.line_types.iteritems()], "tool": self.tool.serialize(), "op_order": self.op_order, "drill_cycles": self.drill_cycles, "gcode_output": self.gcode_output, "undo_budget": self.undo_budget}
 
     def deserialize(self, data):
         self.material = Material(data["material"])
@@ -99,3 +125,19 @@ class Settings:
         for lt in data["linetypes"]:
             self.line_types[lt["name"]] = LineType(data=lt)
         self.tool = Tool(data=data["tool"])
+        if "op_order" in data:
+            self.op_order = data["op_order"]
+        else:
+            self.op_order = OrderEnum.listed
+        if "drill_cycles" in data:
+            self.drill_cycles = data["drill_cycles"]
+        else:
+            self.drill_cycles = DrillCyclesEnum.expanded
+        if "gcode_output" in data:
+            self.gcode_output = data["gcode_output"]
+        else:
+            self.gcode_output = GcodeOutputEnum.compact
+        if "undo_budget" in data:
+            self.undo_budget = data["undo_budget"]
+        else:
+            self.undo_budget = 64
@@ -1,5 +1,8 @@
 from settings import Settings
 
+from logging import debug, info, warning, error, critical
+from util import dbgfname
+
 class State:
     def __init__(self, data=None):
         if data == None:
@@ -62,7 +65,13 @@ class State:
         self.tool_operations+=to
 
     def serialize(self):
-        return {"type": "state", "screen_offset": self.__screen_offset, "base_offset": self.__base_offset, "scale": self.scale, "settings": self.settings.serialize(), 'paths': [p.serialize() for p in self.paths], "tool_operations": [to.serialize() for to in self.tool_operations]}
+        data = self.serialize_view()
+        data.update({"settings": self.settings.serialize(), 'paths': [p.serialize() for p in self.paths], "tool_operations": [to.serialize() for to in self.tool_operations]})
+        return data
+
+    # state fields apart from settings, paths and tool operations
+    def serialize_view(self):
+        return {"type": "state", "screen_offset": self.__screen_offset, "base_offset": self.__base_offset, "scale": self.scale}
 
     def get_path_by_name(self, name):
         for p in self.paths:
@@ -83,7 +92,7 @@ class State:
         from path import Path
         from tool_op_exact_follow import TOExactFollow
         from tool_op_offset_follow import TOOffsetFollow
-        from tool_op_drill import TODrill
+        from tool_op_drill import TODrill, TOMultiDrill
         from tool_op_pocketing import TOPocketing
 
         self.__screen_offset = data["screen_offset"]
@@ -101,6 +110,8 @@ class State:
             op = None
             if to["type"] == "todrill":
                 op = TODrill(state=self, data=to)
+            elif to["type"] == "tomultidrill":
+                op = TOMultiDrill(state=self, data=to)
             elif to["type"] == "toexactfollow":
                 op = TOExactFollow(state=self, data=to)
             elif to["type"] == "tooffsetfollow":
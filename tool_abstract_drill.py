@@ -0,0 +1,28 @@
+import math
+from tool_operation import ToolOperation
+
+class TOAbstractDrill(ToolOperation):
+    def __init__(self, state):
+        super(TOAbstractDrill, self).__init__(state)
+
+    def set_lt(self, ctx):
+        ctx.set_source_rgb(1, 0, 0)
+        ctx.set_line_width(0.1)
+
+    def set_fill_lt(self, ctx):
+        ctx.set_source_rgba(1, 0, 0, 0.5)
+        ctx.set_line_width(0.0)
+
+    # centers of the holes to draw
+    def get_centers(self):
+        return []
+
+    def draw(self, ctx):
+        if self.display:
+            for c in self.get_centers():
+                self.set_lt(ctx)
+                ctx.arc(c[0], c[1], (self.tool.diameter/2.0), 0, 2*math.pi);
+                ctx.stroke()
+                self.set_fill_lt(ctx)
+                ctx.arc(c[0], c[1], (self.tool.diameter/2.0), 0, 2*math.pi);
+                ctx.fill()
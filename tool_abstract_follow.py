@@ -1,5 +1,8 @@
+import math
 from tool_operation import ToolOperation
 from state import state
+from calc_utils import pt_to_pt_dist, fit_polyline_arcs
+from elements import ELine, EArc
 
 from logging import debug, info, warning, error, critical
 from util import dbgfname
@@ -45,73 +48,108 @@ class TOAbstractFollow(ToolOperation):
         return p
 
 
-    def process_el_to_gcode(self, e, step):
-        dbgfname()
-        out = ""
-        if type(e).__name__ == "ELine":
-            new_pos = [e.start[0], e.start[1], -step*state.get_tool().diameter/2.0]
-            out+= self.state.settings.default_pp.move_to(new_pos)
-            state.get_tool().current_position = new_pos
-
-            new_pos = [e.end[0], e.end[1], -step*state.get_tool().diameter/2.0]
-            out+= self.state.settings.default_pp.move_to(new_pos)
-            state.get_tool().current_position = new_pos
-        elif type(e).__name__ == "EArc":
-            if e.turnaround:
-                new_pos = [e.start[0], e.start[1], -step*state.get_tool().diameter/2.0]
-                out+= self.state.settings.default_pp.move_to(new_pos)
-                state.get_tool().current_position = new_pos
-                new_pos = [e.end[0], e.end[1], -step*state.get_tool().diameter/2.0]
-                out+= self.state.settings.default_pp.mk_ccw_arc(e.radius, new_pos)
-                state.get_tool().current_position = new_pos
-
+    def __fit_run(self, run, tolerance):
+        pts = [run[0].start]+[e.end for e in run]
+        lt = run[0].lt
+        color = run[0].color
+        out = []
+        for i, j, center, ccw in fit_polyline_arcs([(p[0], p[1]) for p in pts], tolerance):
+            start = [pts[i][0], pts[i][1], 0]
+            end = [pts[j][0], pts[j][1], 0]
+            if center == None:
+                out.append(ELine(start, end, lt, color))
             else:
-                new_pos = [e.start[0], e.start[1], -step*state.get_tool().diameter/2.0]
-                out+= self.state.settings.default_pp.move_to(new_pos)
-                state.get_tool().current_position = new_pos
-                new_pos = [e.end[0], e.end[1], -step*state.get_tool().diameter/2.0]
-                out+= self.state.settings.default_pp.mk_cw_arc(e.radius, new_pos)
-                state.get_tool().current_position = new_pos
-        elif type(e).__name__ == "ECircle":
-            new_pos = [e.start[0], e.start[1], -step*state.get_tool().diameter/2.0]
-            out+= self.state.settings.default_pp.move_to(new_pos)
-            state.get_tool().current_position = new_pos
-            new_pos = [e.end[0], e.end[1], -step*state.get_tool().diameter/2.0]
-            rel_center = [e.center[0]-e.end[0], e.center[1]-e.end[1], 0]
-            out+= self.state.settings.default_pp.mk_cw_ijk_arc(rel_center, new_pos)
-            state.get_tool().current_position = new_pos
-            
-        else:
-            debug("unsuported element type: "+str(type(e).__name__))
+                out.append(EArc(center=[center[0], center[1], 0], lt=lt, start=start, end=end, turnaround=(not ccw), color=color))
+        return out
+
+    # Post-pass before G-code output: runs of connected ELines (linearized
+    # arcs, offsets, pocket loops) are replaced by fewer lines and arcs
+    # deviating at most tolerance from them, so the controller gets G02/G03
+    # instead of walls of short G01 segments.
+    def fit_arcs(self, path, tolerance=0.01):
+        out = []
+        run = []
+        for e in path:
+            if type(e).__name__ == "ELine":
+                if len(run)>0 and pt_to_pt_dist(run[-1].end, e.start)>1e-9:
+                    out += self.__fit_run(run, tolerance)
+                    run = []
+                run.append(e)
+                continue
+            if len(run)>0:
+                out += self.__fit_run(run, tolerance)
+                run = []
+            out.append(e)
+        if len(run)>0:
+            out += self.__fit_run(run, tolerance)
         return out
 
+    # Translates the path to postprocessor move records once, depth passes
+    # replay them with emit_compiled instead of dispatching and formatting
+    # every element again for every step.
+    def compile_path(self, path):
+        dbgfname()
+        pp = self.state.settings.default_pp
+        records = []
+        for e in path:
+            if type(e).__name__ == "ELine":
+                records.append(pp.compile_move(e.start))
+                records.append(pp.compile_move(e.end))
+            elif type(e).__name__ == "EArc":
+                # negative radius selects the long way for arcs above 180 degrees
+                r = e.radius
+                if e.get_sweep() > math.pi:
+                    r = -r
+                records.append(pp.compile_move(e.start))
+                if e.is_turnaround:
+                    records.append(pp.compile_cw_arc(r, e.end))
+                else:
+                    records.append(pp.compile_ccw_arc(r, e.end))
+            elif type(e).__name__ == "ECircle":
+                rel_center = [e.center[0]-e.end[0], e.center[1]-e.end[1], 0]
+                records.append(pp.compile_move(e.start))
+                records.append(pp.compile_cw_ijk_arc(rel_center, e.end))
+            else:
+                debug("unsuported element type: "+str(type(e).__name__))
+        return records
+
+    # one depth pass over compiled records, path ends at the last element
+    def emit_pass(self, records, path, step):
+        z = -step*self.tool.diameter/2.0
+        for line in self.state.settings.default_pp.emit_compiled(records, z):
+            yield line
+        end = path[-1].end
+        self.tool.current_position = [end[0], end[1], z]
 
     def get_gcode_base(self, path):
+        if path == None or len(path) == 0:
+            warning("  "+str(self.display_name)+" has an empty path, nothing to cut")
+            return
+        path = self.fit_arcs(path)
+        records = self.compile_path(path)
         cp = self.tool.current_position
-        out = ""
         new_pos = [cp[0], cp[1], self.tool.default_height]
-        out+= self.state.settings.default_pp.move_to_rapid(new_pos)
+        yield self.state.settings.default_pp.move_to_rapid(new_pos)
         self.tool.current_position = new_pos
 
         start = path[0].start
 
         new_pos = [start[0], start[1], new_pos[2]]
-        out+= self.state.settings.default_pp.move_to_rapid(new_pos)
+        yield self.state.settings.default_pp.move_to_rapid(new_pos)
         self.tool.current_position = new_pos
 
         for step in range(int(self.depth/(self.tool.diameter/2.0))+1):
-            for e in path:
-                out += self.process_el_to_gcode(e, step)
+            for line in self.emit_pass(records, path, step):
+                yield line
 
             new_pos = [self.tool.current_position[0], self.tool.current_position[1], self.tool.default_height]
-            out+= self.state.settings.default_pp.move_to_rapid(new_pos)
+            yield self.state.settings.default_pp.move_to_rapid(new_pos)
             self.tool.current_position = new_pos
 
             new_pos = [start[0], start[1], self.tool.default_height]
-            out+= self.state.settings.default_pp.move_to_rapid(new_pos)
+            yield self.state.settings.default_pp.move_to_rapid(new_pos)
             self.tool.current_position = new_pos
 
         new_pos = [self.tool.current_position[0], self.tool.current_position[1], self.tool.default_height]
-        out+= self.state.settings.default_pp.move_to_rapid(new_pos)
+        yield self.state.settings.default_pp.move_to_rapid(new_pos)
         self.tool.current_position = new_pos
-        return out
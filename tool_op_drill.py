@@ -1,11 +1,12 @@
-import math
-from tool_operation import ToolOperation, TOEnum
+from tool_operation import TOEnum
+from tool_abstract_drill import TOAbstractDrill
 from generalized_setting import TOSetting
 from state import state
+from calc_utils import order_tasks
 
 import json
 
-class TODrill(ToolOperation):
+class TODrill(TOAbstractDrill):
     def __init__(self, state, center=None, depth=0, index=0, data=None):
         self.state = state
         if data == None:
@@ -23,29 +24,17 @@ class TODrill(ToolOperation):
         self.name = TOEnum.drill
 
     def serialize(self):
-        return {'type': 'todrill', 'center': self.center, 'depth': self.depth, 'index': self.index}
+        return {'type': 'todrill', 'center': list(self.center), 'depth': self.depth, 'index': self.index}
 
     def deserialize(self, data):
-        self.center = data["center"]
+        self.center = list(data["center"])
         self.depth = data["depth"]
         self.index = data["index"]
 
-    def set_lt(self, ctx):
-        ctx.set_source_rgb(1, 0, 0)
-        ctx.set_line_width(0.1)
-
-    def set_fill_lt(self, ctx):
-        ctx.set_source_rgba(1, 0, 0, 0.5)
-        ctx.set_line_width(0.0)
-
-    def draw(self, ctx):
-        if self.display:
-            self.set_lt(ctx)
-            ctx.arc(self.center[0], self.center[1], (self.tool.diameter/2.0), 0, 2*math.pi);
-            ctx.stroke()
-            self.set_fill_lt(ctx)
-            ctx.arc(self.center[0], self.center[1], (self.tool.diameter/2.0), 0, 2*math.pi);
-            ctx.fill()
+    def get_centers(self):
+        if self.center == None:
+            return []
+        return [self.center]
 
     def apply(self, element, depth=0):
         self.depth = depth
@@ -71,24 +60,113 @@ class TODrill(ToolOperation):
 
     def get_gcode(self):
         cp = self.tool.current_position
-        out = ""
         new_pos = [cp[0], cp[1], self.tool.default_height]
-        out+= self.state.settings.default_pp.move_to_rapid(new_pos)
+        yield self.state.settings.default_pp.move_to_rapid(new_pos)
         self.tool.current_position = new_pos
         new_pos = [self.center[0], self.center[1], new_pos[2]]
-        out+= self.state.settings.default_pp.move_to_rapid(new_pos)
+        yield self.state.settings.default_pp.move_to_rapid(new_pos)
         self.tool.current_position = new_pos
 
         for step in range(int(self.depth/(self.tool.diameter/2.0))+1):
             new_pos = [self.center[0], self.center[1], -step*self.tool.diameter/2.0]
-            out+= self.state.settings.default_pp.move_to(new_pos)
+            yield self.state.settings.default_pp.move_to(new_pos)
             new_pos = [self.center[0], self.center[1], self.tool.diameter]
-            out+= self.state.settings.default_pp.move_to_rapid(new_pos)
+            yield self.state.settings.default_pp.move_to_rapid(new_pos)
             
         new_pos = [self.center[0], self.center[1], self.tool.default_height]
-        out+= self.state.settings.default_pp.move_to_rapid(new_pos)
+        yield self.state.settings.default_pp.move_to_rapid(new_pos)
         self.tool.current_position = new_pos
-        return out
+
+    def get_entry_pt(self):
+        return self.center
 
     def __repr__(self):
         return "<Drill at "+str(self.center)+">"
+
+# All drillable elements of a selection in one operation. Holes are ordered
+# to shorten the moves between them, the tool travels at the retract height
+# (one tool diameter above the material) and every hole is one canned cycle
+# if the postprocessor has them, otherwise the pecks are expanded.
+class TOMultiDrill(TOAbstractDrill):
+    def __init__(self, state, depth=0, index=0, data=None):
+        self.state = state
+        if data == None:
+            self.index = index
+            self.centers = []
+            self.depth = depth
+        else:
+            self.deserialize(data)
+
+        super(TOMultiDrill, self).__init__(state)
+        self.display_name = TOEnum.multi_drill+" "+str(self.index)
+        self.name = TOEnum.multi_drill
+
+    def serialize(self):
+        return {'type': 'tomultidrill', 'centers': [list(c) for c in self.centers], 'depth': self.depth, 'index': self.index}
+
+    def deserialize(self, data):
+        self.centers = [list(c) for c in data["centers"]]
+        self.depth = data["depth"]
+        self.index = data["index"]
+
+    def get_centers(self):
+        return self.centers
+
+    def apply(self, elements, depth=0):
+        self.depth = depth
+        centers = [list(e.center[:2]) for e in elements if e.operations[TOEnum.drill]]
+        if len(centers) == 0:
+            return False
+        order = order_tasks(centers, centers, self.tool.current_position)
+        self.centers = [centers[i] for i in order]
+        return True
+
+    def get_settings_list(self):
+        settings_lst = [TOSetting("float", 0, self.state.get_settings().get_material().get_thickness(), self.depth, "Depth, mm: ", self.set_depth_s)]
+        return settings_lst
+
+    def set_depth_s(self, setting):
+        self.depth = setting.new_value
+
+    def get_gcode(self):
+        pp = self.state.settings.default_pp
+        peck = self.tool.diameter/2.0
+        n_pecks = int(self.depth/peck)+1
+        retract = self.tool.diameter
+
+        cp = self.tool.current_position
+        new_pos = [cp[0], cp[1], self.tool.default_height]
+        yield pp.move_to_rapid(new_pos)
+        new_pos = [self.centers[0][0], self.centers[0][1], self.tool.default_height]
+        yield pp.move_to_rapid(new_pos)
+
+        cycle = None
+        for c in self.centers:
+            bottom = [c[0], c[1], -(n_pecks-1)*peck]
+            cycle = pp.mk_drill_cycle(bottom, retract, peck if n_pecks>2 else None)
+            if cycle != None:
+                yield cycle
+                continue
+            yield pp.move_to_rapid([c[0], c[1], retract])
+            for step in range(n_pecks):
+                yield pp.move_to([c[0], c[1], -step*peck])
+                yield pp.move_to_rapid([c[0], c[1], retract])
+        if cycle != None:
+            yield pp.cancel_drill_cycle()
+
+        new_pos = [self.centers[-1][0], self.centers[-1][1], self.tool.default_height]
+        yield pp.move_to_rapid(new_pos)
+        self.tool.current_position = new_pos
+
+    def get_entry_pt(self):
+        if len(self.centers) == 0:
+            return None
+        return self.centers[0]
+
+    def get_exit_pt(self):
+        if len(self.centers) == 0:
+            return None
+        return self.centers[-1]
+
+    def __repr__(self):
+        return "<Drill at "+str(len(self.centers))+" holes>"
@@ -47,5 +47,10 @@ class TOExactFollow(TOAbstractFollow):
     def get_gcode(self):
         return self.get_gcode_base(self.path.ordered_elements)
 
+    def get_entry_pt(self):
+        if self.path == None or len(self.path.ordered_elements) == 0:
+            return None
+        return self.path.ordered_elements[0].start
+
     def __repr__(self):
         return "<Exact follow>"
@@ -2,7 +2,7 @@ import math
 from tool_operation import ToolOperation, TOEnum
 from tool_abstract_follow import TOAbstractFollow
 from generalized_setting import TOSetting
-from calc_utils import find_vect_normal, mk_vect, normalize, vect_sum, vect_len, scale_vect, pt_to_pt_dist
+from calc_utils import find_vect_normal, mk_vect, normalize, vect_sum, vect_len, scale_vect, pt_to_pt_dist, line_line_intersection, circle_segment_intersections, circle_circle_intersections, offset_polygons
 from elements import ELine, EArc, ECircle
 
 from logging import debug, info, warning, error, critical
@@ -11,6 +11,12 @@ from util import dbgfname
 import cairo
 import json
 
+class OffsetModeEnum:
+    normals = "normals"
+    arcs = "arcs"
+    polygons = "polygons"
+    options = [normals, arcs, polygons]
+
 class TOOffsetFollow(TOAbstractFollow):
     def __init__(self, state, depth=0, index=0, offset=0, data=None):
         super(TOAbstractFollow, self).__init__(state)
@@ -23,19 +29,24 @@ class TOOffsetFollow(TOAbstractFollow):
             self.path = None
             self.offset_path = None
             self.scale_center = [0, 0]
+            self.mode = OffsetModeEnum.arcs
         else:
             self.deserialize(data)
 
         self.display_name = TOEnum.offset_follow+" "+str(self.index)
 
     def serialize(self):
-        return {'type': 'tooffsetfollow', 'path_ref': self.path.name, 'depth': self.depth, 'index': self.index, 'offset': self.offset, 'scale_center': self.scale_center}
+        return {'type': 'tooffsetfollow', 'path_ref': self.path.name, 'depth': self.depth, 'index': self.index, 'offset': self.offset, 'scale_center': list(self.scale_center), 'mode': self.mode}
 
     def deserialize(self, data):
         self.depth = data["depth"]
         self.index = data["index"]
         self.offset = data["offset"]
-        self.scale_center = data["scale_center"]
+        self.scale_center = list(data["scale_center"])
+        if "mode" in data:
+            self.mode = data["mode"]
+        else:
+            self.mode = OffsetModeEnum.normals
 
         p = self.try_load_path_by_name(data["path_ref"], self.state)
         if p:
@@ -45,7 +56,8 @@ class TOOffsetFollow(TOAbstractFollow):
         settings_lst = [TOSetting("float", 0, self.state.settings.material.thickness, self.depth, "Depth, mm: ", self.set_depth_s),
                         TOSetting("float", None, None, 1.0, "Offset, mm: ", self.set_offset_s),
                         TOSetting("float", None, None, 1.0, "Scale center x: ", self.set_scale_center_x_s),
-                        TOSetting("float", None, None, 1.0, "Scale center y: ", self.set_scale_center_y_s)]
+                        TOSetting("float", None, None, 1.0, "Scale center y: ", self.set_scale_center_y_s),
+                        TOSetting("enum", None, None, self.mode, "Offset mode: ", self.set_mode_s, OffsetModeEnum.options)]
         return settings_lst
 
     def set_depth_s(self, setting):
@@ -66,9 +78,153 @@ class TOOffsetFollow(TOAbstractFollow):
         self.__build_offset_path(self.path)
         self.draw_list = self.offset_path
 
+    def set_mode_s(self, setting):
+        self.mode = setting.new_value
+        self.__build_offset_path(self.path)
+        self.draw_list = self.offset_path
+
     def __build_offset_path(self, p):
+        if self.mode == OffsetModeEnum.arcs:
+            return self.__build_offset_path_arcs(p)
+        if self.mode == OffsetModeEnum.polygons:
+            return self.__build_offset_path_polygons(p)
         return self.__build_offset_path_normals(p)
 
+    def __tangent(self, e, pt):
+        if type(e).__name__ == "EArc":
+            return e.get_tangent(pt)
+        return normalize(mk_vect(e.start, e.end))
+
+    # element shifted by offset to the right of its direction: lines are
+    # moved along the normal, arcs keep center and change radius
+    def __offset_element(self, e):
+        if type(e).__name__ == "ELine":
+            if pt_to_pt_dist(e.start, e.end) < 1e-9:
+                return None
+            n = e.get_normalized_start_normal()
+            s_pt = [n[0]*self.offset+e.start[0], n[1]*self.offset+e.start[1], 0]
+            e_pt = [n[0]*self.offset+e.end[0], n[1]*self.offset+e.end[1], 0]
+            return ELine(s_pt, e_pt, e.lt, e.color)
+        elif type(e).__name__ == "EArc":
+            if e.is_turnaround:
+                r = e.radius-self.offset
+            else:
+                r = e.radius+self.offset
+            if r < 1e-9:
+                return None
+            s_pt = self.__move_on_radius(e.center, e.start, r)
+            e_pt = self.__move_on_radius(e.center, e.end, r)
+            return EArc(center=e.center, lt=e.lt, start=s_pt, end=e_pt, turnaround=e.is_turnaround, color=e.color)
+        return None
+
+    def __move_on_radius(self, center, pt, r):
+        v = normalize(mk_vect(center, pt))
+        return [center[0]+v[0]*r, center[1]+v[1]*r, 0]
+
+    def __with_ends(self, e, start, end):
+        if type(e).__name__ == "EArc":
+            return EArc(center=e.center, lt=e.lt, start=start, end=end, turnaround=e.is_turnaround, color=e.color)
+        return ELine(start, end, e.lt, e.color)
+
+    # intersection of the lines/circles the elements lay on, closest to pt
+    def __corner_intersection(self, prev, next, pt):
+        prev_arc = type(prev).__name__ == "EArc"
+        next_arc = type(next).__name__ == "EArc"
+        if prev_arc and next_arc:
+            pts = circle_circle_intersections(prev.center, prev.radius, next.center, next.radius)
+        elif prev_arc:
+            pts = circle_segment_intersections(prev.center, prev.radius, next.start, next.end, False)
+        elif next_arc:
+            pts = circle_segment_intersections(next.center, next.radius, prev.start, prev.end, False)
+        else:
+            ipt = line_line_intersection(prev.start, prev.end, next.start, next.end)
+            pts = [] if ipt == None else [ipt]
+        if len(pts) == 0:
+            return None
+        ipt = min(pts, key=lambda p: pt_to_pt_dist(p, pt))
+        return [ipt[0], ipt[1], 0]
+
+    # Joins offsets of two consecutive elements meeting at pt: on the outer
+    # side of a corner the gap is closed with an arc around pt, on the inner
+    # side both offsets are trimmed at their intersection.
+    def __join_offsets(self, prev, next, prev_orig, next_orig, pt):
+        if pt_to_pt_dist(prev.end, next.start) < 1e-9:
+            return prev, None, self.__with_ends(next, prev.end, next.end)
+        tp = self.__tangent(prev_orig, prev_orig.end)
+        tn = self.__tangent(next_orig, next_orig.start)
+        turn = tp[0]*tn[1]-tp[1]*tn[0]
+        if turn*self.offset > 0:
+            c = [pt[0], pt[1], 0]
+            rounding = EArc(center=c, lt=prev.lt, start=prev.end, end=next.start, turnaround=(self.offset<0), color=prev.color)
+            return prev, rounding, next
+        ipt = self.__corner_intersection(prev, next, pt)
+        if ipt == None:
+            return prev, ELine(prev.end, next.start, prev.lt, prev.color), next
+        return self.__with_ends(prev, prev.start, ipt), None, self.__with_ends(next, ipt, next.end)
+
+    # Offsets arcs analytically (same center, radius changed by offset)
+    # instead of splitting them into lines, so the offset path stays mostly
+    # arcs. Corners are joined by __join_offsets.
+    def __build_offset_path_arcs(self, p):
+        dbgfname()
+        elements = p.get_ordered_elements()
+        if len(elements)<=1:
+            return self.__build_offset_path_normals(p)
+
+        originals = []
+        offsets = []
+        for e in elements:
+            oe = self.__offset_element(e)
+            if oe != None:
+                originals.append(e)
+                offsets.append(oe)
+        if len(offsets) == 0:
+            self.offset_path = []
+            return
+
+        closed = pt_to_pt_dist(elements[-1].end, elements[0].start)<0.001
+        joints = [None]*len(offsets)
+        for i in range(len(offsets)-1):
+            prev, joints[i], offsets[i+1] = self.__join_offsets(offsets[i], offsets[i+1], originals[i], originals[i+1], originals[i].end)
+            offsets[i] = prev
+        if closed and len(offsets)>1:
+            offsets[-1], joints[-1], offsets[0] = self.__join_offsets(offsets[-1], offsets[0], originals[-1], originals[0], originals[-1].end)
+
+        new_elements = []
+        for i, oe in enumerate(offsets):
+            new_elements.append(oe)
+            if joints[i] != None:
+                new_elements.append(joints[i])
+        self.offset_path = new_elements
+        debug("  offset_path: "+str(self.offset_path))
+
+    # Offsets the linearized closed path with PolygonOffset, which removes
+    # the parts of the offset cutting into the part on concave corners and
+    # narrow slots. The result may be several loops or none at all. Open
+    # paths are offset in arcs mode.
+    def __build_offset_path_polygons(self, p):
+        dbgfname()
+        elements = p.get_ordered_elements()
+        if len(elements)<=1 or pt_to_pt_dist(elements[-1].end, elements[0].start)>=0.001:
+            return self.__build_offset_path_arcs(p)
+        loop = []
+        for e in elements:
+            if type(e).__name__ == "EArc":
+                lines = e.linearize(0.01)
+            else:
+                lines = [e]
+            loop += [l.start for l in lines]
+        lt = elements[0].lt
+        color = elements[0].color
+        new_elements = []
+        for pts in offset_polygons([loop], self.offset):
+            for i in range(len(pts)):
+                s_pt = [pts[i-1][0], pts[i-1][1], 0]
+                e_pt = [pts[i][0], pts[i][1], 0]
+                new_elements.append(ELine(s_pt, e_pt, lt, color))
+        self.offset_path = new_elements
+        debug("  offset_path: "+str(self.offset_path))
+
     def __two_point_offset(self, prev, next):
         dbgfname()
         nsc = next.start
@@ -141,26 +297,7 @@ class TOOffsetFollow(TOAbstractFollow):
             converted_elements = []
             for i, e in enumerate(elements):
                 if type(e).__name__ == "EArc":
-                    sa = e.startangle
-                    ea = e.endangle
-                    if sa > ea:
-                        ea+=math.pi*2
-                    da = (ea - sa)
-
-                    
-                    n_steps = int(da/0.1)
-                    s_pt = (e.center[0]+math.cos(sa)*e.radius, e.center[1]+math.sin(sa)*e.radius)
-                    debug("  splitting arc, start angle: "+str(sa)+" start_pt: "+str(s_pt))
-                    for i in range(1,n_steps):
-                        a = sa+i*0.1
-                        e_pt = (e.center[0]+math.cos(a)*e.radius, e.center[1]+math.sin(a)*e.radius)
-                        ne = ELine(s_pt, e_pt, e.lt, e.color)
-                        debug("  angle: "+str(a)+" line: "+str(s_pt)+" "+str(e_pt))
-                        s_pt = e_pt
-                        converted_elements.append(ne)
-                    e_pt = e.end
-                    ne = ELine(s_pt, e_pt, e.lt, e.color)
-                    converted_elements.append(ne)
+                    converted_elements += e.linearize(0.01)
                 else:
                     converted_elements.append(e)
 
@@ -270,11 +407,19 @@ class TOOffsetFollow(TOAbstractFollow):
                 self.path = path
                 self.__build_offset_path(path)
                 self.draw_list = self.offset_path
+                if self.offset_path == None or len(self.offset_path) == 0:
+                    warning("  offset of "+str(path.name)+" is empty")
+                    return False
                 return True
         return False
 
     def get_gcode(self):
-        return self.get_gcode_base(self.path.ordered_elements)
+        return self.get_gcode_base(self.offset_path)
+
+    def get_entry_pt(self):
+        if self.offset_path == None or len(self.offset_path) == 0:
+            return None
+        return self.offset_path[0].start
 
     def __repr__(self):
         return "<Exact follow>"
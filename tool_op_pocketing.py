@@ -2,14 +2,21 @@ import math
 from tool_operation import ToolOperation, TOEnum
 from tool_abstract_follow import TOAbstractFollow
 from generalized_setting import TOSetting
-from calc_utils import find_vect_normal, mk_vect, normalize, vect_sum, vect_len, linearized_path_aabb, find_center_of_mass, sign, LineUtils
-from elements import ELine, EArc, EPoint
+from calc_utils import find_vect_normal, mk_vect, normalize, vect_sum, vect_len, linearized_path_aabb, find_center_of_mass, sign, LineUtils, ElementGrid, pt_to_pt_dist, circle_segment_intersections, circle_circle_intersections, offset_polygons, polygon_area, pts_in_path_winding
+from elements import ELine, EArc, ECircle, EPoint
 
 from logging import debug, info, warning, error, critical
 from util import dbgfname
 
 import json
 import cairo
+import numpy as np
+
+class PocketStrategyEnum:
+    rings = "rings"
+    contour = "contour"
+    raster = "raster"
+    options = [rings, contour, raster]
 
 class TOPocketing(TOAbstractFollow):
     def __init__(self, state, depth=0, index=0, offset=0, data=None):
@@ -22,12 +29,16 @@ class TOPocketing(TOAbstractFollow):
             self.offset = 0
             self.path = None
             self.offset_path = None
+            self.strategy = PocketStrategyEnum.contour
+            self.angle = 0
+            self.pocket_chains = []
         else:
+            self.pocket_chains = []
             self.deserialize(data)
         self.display_name = TOEnum.pocket+" "+str(self.index)
 
     def serialize(self):
-        return {'type': 'topocketing', 'path_ref': self.path.name, 'depth': self.depth, 'index': self.index, 'offset': self.offset}
+        return {'type': 'topocketing', 'path_ref': self.path.name, 'depth': self.depth, 'index': self.index, 'offset': self.offset, 'strategy': self.strategy, 'angle': self.angle}
 
     def __draw_elements(self, ctx):
         if self.draw_list != None:
@@ -48,8 +59,8 @@ class TOPocketing(TOAbstractFollow):
     def __linearize_path(self, path, tolerance):
         linearized_path = []
         for e in path:
-            if type(e).__name__ == "EArc":
-                lpath = e.to_line_sequence(tolerance)
+            if type(e).__name__ == "EArc" or type(e).__name__ == "ECircle":
+                lpath = e.linearize(tolerance)
                 linearized_path += lpath
             elif type(e).__name__ == "ELine":
                 linearized_path.append(e)
@@ -184,10 +195,103 @@ class TOPocketing(TOAbstractFollow):
             return True
         return False
 
-    def build_points(self, path):
+    # edge table for scanline classification: every element together with
+    # the y range in which it can cross or halfcross a scanline, sorted by
+    # the lower bound, so that rows going up only have to advance a cursor
+    def __mk_edge_table(self, path):
+        edges = []
+        for e in path:
+            ymin = min(e.start[1], e.end[1])-0.001
+            ymax = max(e.start[1], e.end[1])+0.001
+            edges.append((ymin, ymax, e))
+        edges.sort(key=lambda et: et[0])
+        return edges
+
+    # number of leading samples of the row for which __is_point_at_left holds,
+    # the predicate is monotone in x, so bisection is enough
+    def __count_pts_at_left(self, e, y, xs, up):
+        lo = 0
+        hi = len(xs)
+        while lo<hi:
+            mid = (lo+hi)//2
+            if self.__is_point_at_left((xs[mid], y), e, up):
+                lo = mid+1
+            else:
+                hi = mid
+        return lo
+
+    # classifies the whole row of samples xs at height y with the same
+    # crossing rules as __is_pt_inside_path_winding, but every active element
+    # is visited once per row instead of once per sample
+    def __classify_row(self, y, xs, active):
+        turns_diff = [0]*(len(xs)+1)
+        for e in active:
+            # crossing classification depends on y only
+            el_coords = [[e.start[0]-xs[0], e.start[1]-y], [e.end[0]-xs[0], e.end[1]-y]]
+            halfcross, up = self.__is_element_halfcrossing(el_coords)
+            if halfcross:
+                weight = 0.5
+            elif self.__is_element_crossing(el_coords):
+                up = self.__is_crossing_up(el_coords)
+                weight = 1
+            else:
+                continue
+            if not up:
+                weight = -weight
+            n_left = self.__count_pts_at_left(e, y, xs, up)
+            turns_diff[0] += weight
+            turns_diff[n_left] -= weight
+
+        inside = []
+        turns = 0
+        for i in range(len(xs)):
+            turns += turns_diff[i]
+            inside.append(abs(turns) >= 1)
+        return inside
+
+    # Scanline variant of the grid sampling. The edge table is sorted once
+    # (O(E log E)), every row only touches the elements active at its height
+    # and bisects the row for each of them, then a prefix sum classifies all
+    # samples of the row. Total cost is O(E log E + sum(A_row*log X) + X*Y)
+    # instead of O(X*Y*E) for per point winding, where E is the number of
+    # linearized elements, A_row the number of elements spanning the row and
+    # X, Y the grid dimensions.
+    def __build_points_scanline(self, lpath, left, right, top, bottom, step):
+        xs = []
+        x = left
+        while (x<right):
+            xs.append(x)
+            x += step
+        ys = []
+        y = bottom
+        while (y<top):
+            ys.append(y)
+            y += step
+        if len(xs) == 0 or len(ys) == 0:
+            return []
+
+        edges = self.__mk_edge_table(lpath)
+        next_edge = 0
+        active = []
+        rows = []
+        for y in ys:
+            while next_edge<len(edges) and edges[next_edge][0]<=y:
+                active.append(edges[next_edge])
+                next_edge += 1
+            active = [et for et in active if et[1]>=y]
+            rows.append(self.__classify_row(y, xs, [et[2] for et in active]))
+
+        points = []
+        for i, x in enumerate(xs):
+            for j, y in enumerate(ys):
+                if rows[j][i]:
+                    points.append(EPoint(center=[x, y], lt=self.state.settings.get_def_lt()))
+        return points
+
+    def build_points(self, path, scanline=True):
         dbgfname()
         debug("  linearizing path")
-        lpath = self.__linearize_path(path, 0.1)
+        lpath = self.__linearize_path(path, 0.01)
         #lpath = path
 
         path_aabb = linearized_path_aabb(lpath)
@@ -197,6 +301,10 @@ class TOPocketing(TOAbstractFollow):
         bottom = path_aabb.bottom - 10
         points = []
         step = 0.5
+        if scanline:
+            points = self.__build_points_scanline(lpath, left, right, top, bottom, step)
+            debug("  points: "+str(len(points)))
+            return points
         total_points = int(right-left+1)*int(top-bottom+1)/step
         debug("  AABB: "+str(path_aabb))
         point_counter = 0
@@ -214,18 +322,95 @@ class TOPocketing(TOAbstractFollow):
         debug("  points: "+str(points))
         return points
 
-    def __check_if_pt_is_close(self, pt, path):
+    def __check_if_pt_is_close(self, pt, grid):
         tool_diameter = self.state.settings.get_tool().diameter/2.0
-        for e in path:
-            cu = e.get_cu()
-            if (cu.distance_to_pt(pt)<=(tool_diameter)):
-                return True
-        return False
-
-    def build_circles(self, path):
+        return grid.is_pt_close(pt, tool_diameter)
+
+    # angles (in degrees) where the ring may enter or leave the area that is
+    # farther than tool_radius from the path: intersections of the ring with
+    # both sides of every element shifted by tool_radius and with the caps
+    # around element ends
+    def __ring_critical_angles(self, center, r, lpath, tool_radius):
+        pts = []
+        for e in lpath:
+            if pt_to_pt_dist(e.start, e.end) < 1e-9:
+                continue
+            lu = e.get_cu()
+            if lu.distance_to_pt(center) > r+tool_radius:
+                continue
+            if max(pt_to_pt_dist(center, e.start), pt_to_pt_dist(center, e.end)) < r-tool_radius:
+                continue
+            n = lu.get_normalized_start_normal()
+            for side in [-1, 1]:
+                s = (e.start[0]+side*n[0]*tool_radius, e.start[1]+side*n[1]*tool_radius)
+                en = (e.end[0]+side*n[0]*tool_radius, e.end[1]+side*n[1]*tool_radius)
+                pts += circle_segment_intersections(center, r, s, en)
+            for p in [e.start, e.end]:
+                pts += circle_circle_intersections(center, r, p, tool_radius)
+        angles = set()
+        for p in pts:
+            angles.add(math.degrees(math.atan2(p[1]-center[1], p[0]-center[0]))%360)
+        return sorted(angles)
+
+    def __is_ring_pt_valid(self, center, r, angle, lpath, grid):
+        pt = [center[0]+r*math.cos(math.radians(angle)), center[1]+r*math.sin(math.radians(angle))]
+        if self.__check_if_pt_is_close(pt, grid):
+            return False
+        return self.__is_pt_inside_path_winding(pt, lpath)
+
+    # Ring is split at the critical angles, the tool position can change
+    # between inside and outside only there, so one test at the middle of
+    # every span classifies the whole span. Costs O(E+K*E) per ring for K
+    # critical angles instead of 3600 samples.
+    def __build_ring_analytic(self, center, r, lpath, grid):
+        tool_radius = self.state.settings.get_tool().diameter/2.0
+        angles = self.__ring_critical_angles(center, r, lpath, tool_radius)
+        lt = self.state.settings.get_def_lt()
+        if len(angles) == 0:
+            if self.__is_ring_pt_valid(center, r, 0, lpath, grid):
+                return [ECircle(center=center, radius=r, lt=lt)]
+            return []
+
+        spans = []
+        for i, a in enumerate(angles):
+            if i+1<len(angles):
+                b = angles[i+1]
+            else:
+                b = angles[0]+360
+            spans.append([a, b, self.__is_ring_pt_valid(center, r, (a+b)/2.0, lpath, grid)])
+
+        first_invalid = None
+        for i, sp in enumerate(spans):
+            if not sp[2]:
+                first_invalid = i
+                break
+        # a full ring has the same start and end, as an R arc it would go
+        # nowhere, it is cut as a circle (IJK arc) instead
+        if first_invalid == None:
+            return [ECircle(center=center, radius=r, lt=lt)]
+
+        # start right after an invalid span, so that arcs crossing 0 are merged
+        spans = spans[first_invalid+1:]+spans[:first_invalid+1]
+        arcs = []
+        start_angle = None
+        end_angle = None
+        for a, b, valid in spans:
+            if valid:
+                if start_angle == None:
+                    start_angle = a
+                end_angle = b
+            elif start_angle != None:
+                arcs.append(EArc(center=center, radius=r, startangle=start_angle%360, endangle=end_angle%360, lt=lt))
+                start_angle = None
+        return arcs
+
+    def build_circles(self, path, analytic=True):
         dbgfname()
         debug("  linearizing path")
-        lpath = self.__linearize_path(path, 0.1)
+        lpath = self.__linearize_path(path, 0.01)
+        if len(lpath) == 0:
+            return []
+        grid = ElementGrid(lpath)
         #x, y = find_center_of_mass(lpath)
 
         path_aabb = linearized_path_aabb(lpath)
@@ -244,6 +429,9 @@ class TOPocketing(TOAbstractFollow):
         while r < max_r:
             debug("  r: %f"%(r,))
             r+=tool_radius
+            if analytic:
+                tool_paths += self.__build_ring_analytic([x, y], r, lpath, grid)
+                continue
             angle = 0
             cur_x = x+r*math.cos(angle)
             cur_y = y+r*math.sin(angle)
@@ -254,14 +442,14 @@ class TOPocketing(TOAbstractFollow):
                 debug("  cx: %f, cy: %f"%(cur_x, cur_y))
                 debug("  s start: "+str(start_angle))
                 is_inside = True
-            if self.__check_if_pt_is_close([cur_x, cur_y], lpath):
+            if self.__check_if_pt_is_close([cur_x, cur_y], grid):
                 if is_inside:
                     is_inside = False
 
             while angle<=360:
                 cur_x = x+r*math.cos(math.radians(angle))
                 cur_y = y+r*math.sin(math.radians(angle))
-                close = self.__check_if_pt_is_close([cur_x, cur_y], lpath)
+                close = self.__check_if_pt_is_close([cur_x, cur_y], grid)
                 if not close:
                     in_winding = self.__is_pt_inside_path_winding([cur_x, cur_y], lpath)
                     if in_winding and (not is_inside):
@@ -292,17 +480,230 @@ class TOPocketing(TOAbstractFollow):
                         
         return tool_paths
             
+    # closest point of the loop to pt: index of the segment it lays on, the
+    # point and its distance
+    def __closest_on_loop(self, pts, pt):
+        s = np.array(pts, dtype=float)
+        v = np.roll(s, -1, axis=0)-s
+        l2 = np.maximum((v*v).sum(axis=1), 1e-12)
+        t = np.clip(((pt[0]-s[:, 0])*v[:, 0]+(pt[1]-s[:, 1])*v[:, 1])/l2, 0, 1)
+        c = s+v*t[:, None]
+        d2 = (c[:, 0]-pt[0])**2+(c[:, 1]-pt[1])**2
+        i = int(np.argmin(d2))
+        return i, (c[i, 0], c[i, 1]), math.sqrt(d2[i])
+
+    # lines going once around the loop, starting and ending at start_pt on
+    # segment first
+    def __loop_to_lines(self, pts, first, start_pt):
+        lt = self.state.settings.get_def_lt()
+        seq = [start_pt]+pts[first+1:]+pts[:first+1]+[start_pt]
+        lines = []
+        for i in range(len(seq)-1):
+            if pt_to_pt_dist(seq[i], seq[i+1])>1e-9:
+                lines.append(ELine([seq[i][0], seq[i][1], 0], [seq[i+1][0], seq[i+1][1], 0], lt))
+        return lines
+
+    # Contour-parallel pocketing: the boundary is offset inwards by the tool
+    # radius and then again by the step over until nothing is left. Every
+    # loop is contained in one loop of the previous level, the chains are
+    # built from the innermost loops outwards and a loop continues the chain
+    # of the closest child when the link stays shorter than two step overs,
+    # so there is one plunge per innermost loop. Returns a list of chains of
+    # connected elements.
+    def build_contours(self, path):
+        dbgfname()
+        lpath = self.__linearize_path(path, 0.01)
+        if len(lpath)<2 or pt_to_pt_dist(lpath[-1].end, lpath[0].start)>=0.001:
+            return []
+        loop = [(e.start[0], e.start[1]) for e in lpath]
+        if polygon_area(loop)<0:
+            loop.reverse()
+
+        tool_radius = self.tool.diameter/2.0
+        step = tool_radius
+        levels = []
+        delta = tool_radius+self.offset
+        while True:
+            loops = offset_polygons([loop], -delta)
+            if len(loops) == 0:
+                break
+            levels.append(loops)
+            delta += step
+        debug("  levels: "+str(len(levels)))
+
+        finished = []
+        # open chains ending on the loops of the level below
+        kid_chains = []
+        for level in reversed(range(len(levels))):
+            loops = levels[level]
+            kids = [[] for l in loops]
+            for chain in kid_chains:
+                end = chain[-1].end
+                parent = None
+                for i, pts in enumerate(loops):
+                    starts = np.array(pts, dtype=float)
+                    if pts_in_path_winding([end[:2]], starts, np.roll(starts, -1, axis=0))[0]:
+                        parent = i
+                        break
+                if parent == None:
+                    finished.append(chain)
+                else:
+                    kids[parent].append(chain)
+
+            chains = []
+            for i, pts in enumerate(loops):
+                best = None
+                for chain in kids[i]:
+                    end = chain[-1].end
+                    first, pt, dist = self.__closest_on_loop(pts, end)
+                    if dist<=2*step and (best == None or dist<best[3]):
+                        best = (chain, first, pt, dist)
+                if best == None:
+                    finished += kids[i]
+                    chains.append(self.__loop_to_lines(pts, 0, pts[0]))
+                    continue
+                chain, first, pt, dist = best
+                finished += [c for c in kids[i] if c is not chain]
+                end = chain[-1].end
+                chain.append(ELine([end[0], end[1], 0], [pt[0], pt[1], 0], self.state.settings.get_def_lt()))
+                chains.append(chain+self.__loop_to_lines(pts, first, pt))
+            kid_chains = chains
+        finished += kid_chains
+        debug("  chains: "+str(len(finished)))
+        return finished
+
+    # x of the crossings of the scanline at height y with the segments,
+    # sorted, vertices on the scanline are counted once
+    def __scanline_xs(self, y, starts, ends):
+        sy = starts[:, 1]
+        ey = ends[:, 1]
+        sel = (np.minimum(sy, ey)<=y) & (np.maximum(sy, ey)>y)
+        s = starts[sel]
+        e = ends[sel]
+        t = (y-s[:, 1])/(e[:, 1]-s[:, 1])
+        return np.sort(s[:, 0]+(e[:, 0]-s[:, 0])*t)
+
+    # straight move between two points of the region boundary stays in the
+    # region when it crosses no boundary segment and its middle is inside
+    def __is_link_inside(self, a, b, starts, ends):
+        r = (b[0]-a[0], b[1]-a[1])
+        sv = ends-starts
+        d = r[0]*sv[:, 1]-r[1]*sv[:, 0]
+        qx = starts[:, 0]-a[0]
+        qy = starts[:, 1]-a[1]
+        sel = np.abs(d)>1e-12
+        t = (qx*sv[:, 1]-qy*sv[:, 0])[sel]/d[sel]
+        u = (qx*r[1]-qy*r[0])[sel]/d[sel]
+        if np.any((t>1e-6) & (t<1-1e-6) & (u>=0) & (u<=1)):
+            return False
+        mid = ((a[0]+b[0])/2.0, (a[1]+b[1])/2.0)
+        return pts_in_path_winding([mid], starts, ends)[0]
+
+    # Raster pocketing: the region reachable by the tool center (boundary
+    # offset inwards by tool radius and offset) is cut by scanlines at the
+    # step over, rotated by self.angle. Spans of following scanlines are
+    # linked into boustrophedon chains as long as the straight link stays in
+    # the region, a new chain (and plunge) starts only when it does not. The
+    # region outline is cut last to remove the scallops left at span ends.
+    # Returns a list of chains of connected elements.
+    def build_raster(self, path):
+        dbgfname()
+        lpath = self.__linearize_path(path, 0.01)
+        if len(lpath)<2 or pt_to_pt_dist(lpath[-1].end, lpath[0].start)>=0.001:
+            return []
+        loop = [(e.start[0], e.start[1]) for e in lpath]
+        if polygon_area(loop)<0:
+            loop.reverse()
+
+        tool_radius = self.tool.diameter/2.0
+        step = tool_radius
+        region = offset_polygons([loop], -(tool_radius+self.offset))
+        if len(region) == 0:
+            return []
+
+        # scanlines are horizontal in the rotated frame
+        a = math.radians(self.angle)
+        ca = math.cos(a)
+        sa = math.sin(a)
+        starts = []
+        ends = []
+        for pts in region:
+            rpts = [(p[0]*ca+p[1]*sa, -p[0]*sa+p[1]*ca) for p in pts]
+            starts += rpts
+            ends += rpts[1:]+rpts[:1]
+        starts = np.array(starts, dtype=float)
+        ends = np.array(ends, dtype=float)
+
+        ymin = starts[:, 1].min()
+        ymax = starts[:, 1].max()
+        n = max(int(math.ceil((ymax-ymin)/step)), 2)
+        rows = []
+        for k in range(1, n):
+            y = ymin+(ymax-ymin)*k/n
+            xs = self.__scanline_xs(y, starts, ends)
+            rows.append([((xs[i], y), (xs[i+1], y)) for i in range(0, len(xs)-1, 2)])
+
+        chains = []
+        for first_row in range(len(rows)):
+            while len(rows[first_row])>0:
+                span = rows[first_row].pop(0)
+                chain = [span]
+                row = first_row+1
+                while row<len(rows):
+                    end = chain[-1][1]
+                    candidates = []
+                    for i, (s, e) in enumerate(rows[row]):
+                        candidates.append((pt_to_pt_dist(end, s), i, (s, e)))
+                        candidates.append((pt_to_pt_dist(end, e), i, (e, s)))
+                    candidates.sort()
+                    nxt = None
+                    for dist, i, sp in candidates:
+                        if self.__is_link_inside(end, sp[0], starts, ends):
+                            nxt = (i, sp)
+                            break
+                    if nxt == None:
+                        break
+                    rows[row].pop(nxt[0])
+                    chain.append((end, nxt[1][0]))
+                    chain.append(nxt[1])
+                    row += 1
+                chains.append(chain)
+        debug("  raster chains: "+str(len(chains)))
+
+        lt = self.state.settings.get_def_lt()
+        tool_paths = []
+        for chain in chains:
+            lines = []
+            for s, e in chain:
+                if pt_to_pt_dist(s, e)>1e-9:
+                    lines.append(ELine([s[0]*ca-s[1]*sa, s[0]*sa+s[1]*ca, 0], [e[0]*ca-e[1]*sa, e[0]*sa+e[1]*ca, 0], lt))
+            if len(lines)>0:
+                tool_paths.append(lines)
+        for pts in region:
+            tool_paths.append(self.__loop_to_lines(pts, 0, pts[0]))
+        return tool_paths
+
     def deserialize(self, data):
         self.depth = data["depth"]
         self.index = data["index"]
         self.offset = data["offset"]
+        if "strategy" in data:
+            self.strategy = data["strategy"]
+        else:
+            self.strategy = PocketStrategyEnum.rings
+        if "angle" in data:
+            self.angle = data["angle"]
+        else:
+            self.angle = 0
         p = self.try_load_path_by_name(data["path_ref"], self.state)
         if p:
             self.apply(p)
 
     def get_settings_list(self):
         settings_lst = [TOSetting("float", 0, self.state.settings.material.thickness, self.depth, "Depth, mm: ", self.set_depth_s),
-                        TOSetting("float", None, None, 0, "Offset, mm: ", self.set_offset_s)]
+                        TOSetting("float", None, None, 0, "Offset, mm: ", self.set_offset_s),
+                        TOSetting("enum", None, None, self.strategy, "Strategy: ", self.set_strategy_s, PocketStrategyEnum.options),
+                        TOSetting("float", None, None, self.angle, "Raster angle, deg: ", self.set_angle_s)]
         return settings_lst
 
     def set_depth_s(self, setting):
@@ -310,10 +711,32 @@ class TOPocketing(TOAbstractFollow):
 
     def set_offset_s(self, setting):
         self.offset = setting.new_value
+        self.__build_pocket_chains()
         #self.__build_offset_path(self.path)
         #self.__build_pocket_path()
         #self.draw_list = self.offset_path+self.pocket_pattern
-        
+
+    def set_strategy_s(self, setting):
+        self.strategy = setting.new_value
+        self.__build_pocket_chains()
+
+    def set_angle_s(self, setting):
+        self.angle = setting.new_value
+        self.__build_pocket_chains()
+
+    def __build_pocket_chains(self):
+        if self.path == None:
+            return
+        if self.strategy == PocketStrategyEnum.contour:
+            self.pocket_chains = self.build_contours(self.path.ordered_elements)
+        elif self.strategy == PocketStrategyEnum.raster:
+            self.pocket_chains = self.build_raster(self.path.ordered_elements)
+        else:
+            self.pocket_chains = [[e] for e in self.build_circles(self.path.ordered_elements)]
+        self.draw_list = []
+        for chain in self.pocket_chains:
+            self.draw_list += chain
+
     def __build_offset_path(self, p):
         if len(p.elements)==0:
             return False
@@ -419,34 +842,50 @@ class TOPocketing(TOAbstractFollow):
                 #self.__build_pocket_path()
                 #self.draw_list = self.offset_path+self.pocket_pattern
                 #self.draw_list = path.ordered_elements
-                self.draw_list = self.build_circles(path.ordered_elements)
+                self.__build_pocket_chains()
+                if len(self.pocket_chains) == 0:
+                    warning("  no pocket chains built for "+str(path.name))
+                    return False
                 return True
         return False
 
-    def get_gcode(self):
+    # retracts and moves over the start of the next chain
+    def __rapid_to(self, pt):
         cp = self.tool.current_position
-        out = ""
         new_pos = [cp[0], cp[1], self.tool.default_height]
-        out+= self.state.settings.default_pp.move_to_rapid(new_pos)
+        yield self.state.settings.default_pp.move_to_rapid(new_pos)
         self.tool.current_position = new_pos
 
-        start = self.offset_path[0].start
-
-        new_pos = [start[0], start[1], new_pos[2]]
-        out+= self.state.settings.default_pp.move_to_rapid(new_pos)
+        new_pos = [pt[0], pt[1], self.tool.default_height]
+        yield self.state.settings.default_pp.move_to_rapid(new_pos)
         self.tool.current_position = new_pos
 
+    # every chain is cut without retracting, the tool goes up only between
+    # chains
+    def get_gcode(self):
+        chains = [self.fit_arcs(chain) for chain in self.pocket_chains]
+        compiled = [self.compile_path(chain) for chain in chains]
         for step in range(int(self.depth/(self.tool.diameter/2.0))+1):
-            for e in self.offset_path:
-                out += self.process_el_to_gcode(e, step)
-            for e in self.pocket_pattern:
-                out += self.process_el_to_gcode(e, step)
-                
+            for chain, records in zip(chains, compiled):
+                for line in self.__rapid_to(chain[0].start):
+                    yield line
+                for line in self.emit_pass(records, chain, step):
+                    yield line
 
-        new_pos = [new_pos[0], new_pos[1], self.tool.default_height]
-        out+= self.state.settings.default_pp.move_to_rapid(new_pos)
+        cp = self.tool.current_position
+        new_pos = [cp[0], cp[1], self.tool.default_height]
+        yield self.state.settings.default_pp.move_to_rapid(new_pos)
         self.tool.current_position = new_pos
-        return out
+
+    def get_entry_pt(self):
+        if len(self.pocket_chains) == 0:
+            return None
+        return self.pocket_chains[0][0].start
+
+    def get_exit_pt(self):
+        if len(self.pocket_chains) == 0:
+            return None
+        return self.pocket_chains[-1][-1].end
 
     def __repr__(self):
         return "<Exact follow>"
@@ -1,11 +1,34 @@
 from tool import Tool
+from calc_utils import pt_to_pt_dist, order_tasks
+
+from logging import debug, info, warning, error, critical
 
 class TOEnum:
     drill = "drill"
+    multi_drill = "multi drill"
     exact_follow = "exact follow"
     offset_follow = "offset follow"
     pocket = "pocket"
 
+class OrderEnum:
+    listed = "as listed"
+    shortest = "shortest rapids"
+    drills_first = "drills first"
+    options = [listed, shortest, drills_first]
+
+# how drilled holes are written: pecks expanded into moves, or one canned
+# cycle per hole for controllers that have G81/G83
+class DrillCyclesEnum:
+    expanded = "expanded moves"
+    canned = "canned cycles"
+    options = [expanded, canned]
+
+# G-code output: only the words that changed, or every word of every move
+class GcodeOutputEnum:
+    compact = "compact"
+    verbose = "verbose"
+    options = [compact, verbose]
+
 class ToolOperation(object):
     def __init__(self, state):
         self.tool=state.settings.tool
@@ -17,8 +40,18 @@ class ToolOperation(object):
     def apply(self, element):
         pass
 
+    # iterable of G-code chunks, operations yield them one by one so the
+    # program is never held in memory as a whole
     def get_gcode(self):
-        return ""
+        return []
+
+    # where the tool starts and ends cutting, None when there is nothing to
+    # cut
+    def get_entry_pt(self):
+        return None
+
+    def get_exit_pt(self):
+        return self.get_entry_pt()
 
     def update(self, args):
         pass
@@ -31,3 +64,36 @@ class ToolOperation(object):
 
     def deserialize(self, data):
         pass
+
+# length of the rapid moves between operations, from start to the first
+# entry and from every exit to the next entry
+def rapid_distance(ops, start):
+    dist = 0
+    pos = start
+    for op in ops:
+        if op.get_entry_pt() == None:
+            continue
+        dist += pt_to_pt_dist(pos, op.get_entry_pt())
+        pos = op.get_exit_pt()
+    return dist
+
+# Reorders operations to shorten rapid moves between them (order_tasks).
+# With drills_first all drills are ordered and emitted before the other
+# operations. Operations without anything to cut stay at the end of their
+# group in the original order.
+def order_tool_operations(ops, start, drills_first=False):
+    if drills_first:
+        drills = [TOEnum.drill, TOEnum.multi_drill]
+        groups = [[op for op in ops if op.name in drills], [op for op in ops if not (op.name in drills)]]
+    else:
+        groups = [ops]
+    result = []
+    pos = start
+    for group in groups:
+        cutting = [op for op in group if op.get_entry_pt() != None]
+        order = order_tasks([op.get_entry_pt()[:2] for op in cutting], [op.get_exit_pt()[:2] for op in cutting], pos)
+        result += [cutting[i] for i in order]+[op for op in group if op.get_entry_pt() == None]
+        if len(order)>0:
+            pos = cutting[order[-1]].get_exit_pt()
+    info("rapid distance before ordering: %.3f mm, after: %.3f mm" % (rapid_distance(ops, start), rapid_distance(result, start)))
+    return result